@@ -1,5 +1,8 @@
 import os
-from flask import Flask, render_template, abort, request, jsonify
+import base64
+import json
+from flask import Flask, Response, render_template, abort, request, jsonify, stream_with_context
+from markupsafe import escape
 # from model import get_cluster, get_cluster_list, types, recover_doc_online
 from model import Model, types
 # from setting import repo, port, repositories, upload_folder, import_endpoint
@@ -12,6 +15,12 @@ from rdflib.plugins.stores.sparqlstore import SPARQLStore
 import tmp
 import time_person_label
 import re
+import summary
+import builder
+import cache
+import wikidata
+import render
+import image_cache
 
 
 app = Flask(__name__, static_folder='static')
@@ -25,6 +34,12 @@ def generate_pkl(sparql, graph, file_path):
     time_person_label.run(sparql, graph, file_path)
 
 
+def get_model(repo, graph_uri):
+    # the cluster summary itself is shared process-wide through summary.registry
+    sparql = SPARQLStore(setting.endpoint + '/' + repo)
+    return Model(sparql, repo, graph_uri)
+
+
 @app.route('/')
 def index():
     repos = {}
@@ -41,11 +56,23 @@ def index():
                            repos=repos)
 
 
+def show_building(model):
+    resp = app.make_response(render_template('building.html',
+                                             url_prefix=url_prefix,
+                                             repo=model.repo,
+                                             graph=model.graph,
+                                             status=model.build_status))
+    resp.status_code = 503
+    resp.headers['Retry-After'] = '10'
+    return resp
+
+
 @app.route('/repo/<repo>')
 def hello_world(repo):
     graph_uri = request.args.get('g', '')
-    sparql = SPARQLStore(setting.endpoint + '/' + repo)
-    model = Model(sparql, repo, graph_uri)
+    model = get_model(repo, graph_uri)
+    if not model.ready:
+        return show_building(model)
     return render_template('clusters.html',
                            url_prefix=url_prefix,
                            repo=repo,
@@ -70,14 +97,115 @@ def static_css(path):
     return app.send_static_file('css/' + path)
 
 
+def show_rendering(name):
+    # a placeholder until the image is on disk, or the error of its render here;
+    # an image unknown to this process is being rendered by another one
+    img_path = render.image_path(name)
+    if os.path.isfile(img_path):
+        return None
+    status = render.renderer.status(img_path) or render.PENDING
+    resp = app.make_response(render_template('rendering.html',
+                                             url_prefix=url_prefix,
+                                             name=name,
+                                             status=status,
+                                             error=render.renderer.error(img_path)))
+    if status == render.PENDING:
+        resp.status_code = 503
+        resp.headers['Retry-After'] = '3'
+    else:
+        resp.status_code = 500
+    return resp
+
+
 @app.route('/viz/<name>')
 def show_bidirection_viz(name):
-    return render_template('viz.html', url_prefix=url_prefix, name=name)
+    return show_rendering(name) or render_template('viz.html', url_prefix=url_prefix, name=name)
 
 
 @app.route('/sviz/<name>')
 def show_viz(name):
-    return render_template('sviz.html', url_prefix=url_prefix, name=name)
+    return show_rendering(name) or render_template('sviz.html', url_prefix=url_prefix, name=name)
+
+
+cluster_kinds = {'entity': types.Entity, 'event': types.Events, 'relation': types.Relation}
+
+
+def encode_cursor(kind, count, uri):
+    return base64.urlsafe_b64encode(json.dumps([kind, int(count), str(uri)]).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    try:
+        kind, count, uri = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except (ValueError, TypeError, UnicodeError):
+        raise ValueError('Invalid cursor: ' + cursor)
+    if kind not in cluster_kinds or not isinstance(count, int) or not isinstance(uri, str):
+        raise ValueError('Invalid cursor: ' + cursor)
+    return kind, count, uri
+
+
+@app.route('/api/clusters/<repo>')
+def cluster_list_api(repo):
+    """
+    Stream cluster summaries by size as NDJSON (or one JSON object with format=json).
+    Every record carries the cursor to pass as ?cursor= to continue after it.
+    """
+    graph_uri = request.args.get('g', default=None)
+    type_ = request.args.get('type', default=None)
+    limit = request.args.get('limit', default=0, type=int)
+    fmt = request.args.get('format', default='ndjson')
+    if (type_ and type_ not in cluster_kinds) or fmt not in {'ndjson', 'json'}:
+        abort(404)
+    kinds = [type_] if type_ else list(cluster_kinds)
+    after = None
+    if request.args.get('cursor'):
+        try:
+            after = decode_cursor(request.args['cursor'])
+        except ValueError:
+            abort(400)
+        if after[0] not in kinds:
+            abort(400)
+        kinds = kinds[kinds.index(after[0]):]
+
+    model = get_model(repo, graph_uri)
+    if not model.ready:
+        resp = jsonify(model.build_status)
+        resp.status_code = 503
+        resp.headers['Retry-After'] = '10'
+        return resp
+
+    def records():
+        n = 0
+        for kind in kinds:
+            key = after[1:] if after and after[0] == kind else None
+            for c in model.get_cluster_list(cluster_kinds[kind], limit - n if limit else None, 0, 'size', key):
+                yield {
+                    'type': kind,
+                    'uri': str(c.uri),
+                    'href': c.href,
+                    'label': str(c.label) if c.label is not None else None,
+                    'count': int(c.count),
+                    'cursor': encode_cursor(kind, c.count, c.uri),
+                }
+                n += 1
+            if limit and n >= limit:
+                return
+
+    def ndjson():
+        for record in records():
+            yield json.dumps(record) + '\n'
+
+    def json_array():
+        yield '{"clusters": ['
+        cursor = None
+        for i, record in enumerate(records()):
+            yield (',' if i else '') + json.dumps(record)
+            cursor = record['cursor']
+        yield '], "cursor": %s}' % json.dumps(cursor)
+
+    if fmt == 'json':
+        return Response(stream_with_context(json_array()), mimetype='application/json')
+    return Response(stream_with_context(ndjson()), mimetype='application/x-ndjson')
 
 
 @app.route('/cluster/entities/<repo>/<uri>')
@@ -90,8 +218,7 @@ def show_entity_cluster(repo, uri):
     graph_uri = request.args.get('g', default=None)
     show_image = request.args.get('image', default=True)
     show_limit = request.args.get('limit', default=100)
-    sparql = SPARQLStore(setting.endpoint + '/' + repo)
-    model = Model(sparql, repo, graph_uri)
+    model = get_model(repo, graph_uri)
     return show_cluster(model, uri, show_image, show_limit)
 
 
@@ -101,8 +228,9 @@ def show_entity_cluster_list(type_, repo):
     limit = request.args.get('limit', default=100, type=int)
     offset = request.args.get('offset', default=0, type=int)
     sortby = request.args.get('sortby', default='size')
-    sparql = SPARQLStore(setting.endpoint + '/' + repo)
-    model = Model(sparql, repo, graph_uri)
+    model = get_model(repo, graph_uri)
+    if not model.ready:
+        return show_building(model)
     if type_ == 'entity':
         return render_template('list.html',
                                url_prefix=url_prefix,
@@ -134,8 +262,7 @@ def show_event_cluster(repo, uri):
     graph_uri = request.args.get('g', default=None)
     show_image = request.args.get('image', default=True)
     show_limit = request.args.get('limit', default=100)
-    sparql = SPARQLStore(setting.endpoint + '/' + repo)
-    model = Model(sparql, repo, graph_uri)
+    model = get_model(repo, graph_uri)
     return show_cluster(model, uri, show_image, show_limit)
 
 
@@ -145,12 +272,13 @@ def show_columbia_cluster(repo, uri):
     uri = 'http://www.columbia.edu/AIDA/' + uri
     show_image = request.args.get('image', default=True)
     show_limit = request.args.get('limit', default=100)
-    sparql = SPARQLStore(setting.endpoint + '/' + repo)
-    model = Model(sparql, repo, graph_uri)
+    model = get_model(repo, graph_uri)
     return show_cluster(model, uri, show_image, show_limit)
 
 
 def show_cluster(model: Model, uri, show_image=True, show_limit=100):
+    if not model.ready:
+        return show_building(model)
     cluster = model.get_cluster(uri)
     show_image = show_image not in {False, 'False', 'false', 'no', '0'}
     show_limit = show_limit not in {False, 'False', 'false', 'no', '0'} and (
@@ -158,6 +286,7 @@ def show_cluster(model: Model, uri, show_image=True, show_limit=100):
     if not cluster:
         abort(404)
     print(cluster.href)
+    cluster.prefetch_members(show_limit)
     return render_template('cluster.html',
                            url_prefix=url_prefix,
                            repo=model.repo,
@@ -167,6 +296,22 @@ def show_cluster(model: Model, uri, show_image=True, show_limit=100):
                            show_limit=show_limit)
 
 
+@app.route('/wikidata/<repo>')
+def cluster_wikidata(repo):
+    # the qnode sections of a cluster page, fetched by the page after it has rendered
+    graph_uri = request.args.get('g', default=None)
+    uri = request.args.get('uri', default=None)
+    show_limit = request.args.get('limit', default='100')
+    show_limit = show_limit not in {'False', 'false', 'no', '0'} and show_limit.isdigit() and int(show_limit)
+    model = get_model(repo, graph_uri)
+    if not model.ready:
+        return jsonify(model.build_status), 503
+    cluster = model.get_cluster(uri) if uri else None
+    if not cluster:
+        abort(404)
+    return jsonify(cluster.wikidata(show_limit))
+
+
 @app.route('/report')
 def show_report():
     update = request.args.get('update', default=False, type=bool)
@@ -183,8 +328,9 @@ def show_doc_pronoun(doc_id):
 def show_entity_gt(repo):
     uri = request.args.get('e', default=None)
     graph_uri = request.args.get('g', default=None)
-    sparql = SPARQLStore(setting.endpoint + '/' + repo)
-    model = Model(sparql, repo, graph_uri)
+    model = get_model(repo, graph_uri)
+    if not model.ready:
+        return show_building(model)
     cluster = model.get_cluster(uri)
     return render_template('groundtruth.html', url_prefix=url_prefix, repo=repo, graph=graph_uri, cluster=cluster)
 
@@ -202,26 +348,23 @@ def import_clusters():
 
     if repo and debug_file:
 
-        # create directory for debug files if doesn't exist
-        data_dir = setting.debug_data
-        if not os.path.isdir(data_dir):
-            os.makedirs(data_dir)
-
-        if graph_uri:
-            filename = repo + '-' + re.sub('[^0-9a-zA-Z]+', '-', graph_uri)
-        else:
-            filename = repo
-
-        file = data_dir + '/' + filename + '.jl'
-
-        # upload file
-        debug_file.save(file)
+        # validate, store and index the upload in one pass
+        try:
+            status = debug.ingest(repo, graph_uri, debug_file.stream)
+        except ValueError as e:
+            return '''
+            <!doctype html>
+            <title>Invalid</title>
+            <h1>Invalid</h1>
+            <p>%s</p>
+            ''' % escape(str(e)), 400
 
         return '''
         <!doctype html>
         <title>Imported</title>
         <h1>Imported</h1>
-        '''
+        <p>%d records (%d members) indexed in %.1f seconds</p>
+        ''' % (status['records'], status['members'], status['seconds'])
 
     else:
         return '''
@@ -261,6 +404,29 @@ def debugger(repo):
         return not_found()
 
 
+@app.route('/build/<repo>', methods=['GET', 'POST'])
+def build_status(repo):
+    graph_uri = request.args.get('g', default=None)
+    if request.method == 'POST':
+        # compare the clusters with the graph now and merge what changed
+        model = get_model(repo, graph_uri)
+        if model.ready:
+            model.refresh()
+    return jsonify(builder.status(repo, graph_uri))
+
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify({
+        'summary': summary.registry.stats(),
+        'queries': cache.default.stats(),
+        'wikidata': wikidata.stats(),
+        'groundtruth': gt.stats(),
+        'render': render.stats(),
+        'images': image_cache.stats(),
+    })
+
+
 @app.errorhandler(404)
 def not_found(error=None):
     message = {
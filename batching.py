@@ -0,0 +1,20 @@
+"""
+VALUES batches of the queries that look up many uris or ids at once.
+
+Queries are sent as GET requests, so a batch is kept small enough for the
+endpoint's URL limit (8-16 KB); every batched query uses these helpers.
+"""
+from rdflib import URIRef
+
+batch_size = 100  # uris or ids per VALUES clause
+
+
+def batches(items):
+    # sorted, so that the same items always make the same queries (and cache keys)
+    items = sorted(items)
+    for i in range(0, len(items), batch_size):
+        yield items[i:i + batch_size]
+
+
+def values(var, items, term=URIRef):
+    return 'VALUES ?%s { %s }' % (var, ' '.join(term(i).n3() for i in items))
@@ -0,0 +1,215 @@
+import json
+import os
+import threading
+import time
+import traceback
+from rdflib.plugins.stores.sparqlstore import SPARQLStore
+import cache
+import setting
+import summary
+import tmp
+import time_person_label
+
+lock_timeout = 12 * 60 * 60  # a lock file older than this is considered abandoned
+retry_delay = 60  # seconds to wait before retrying a failed build
+check_interval = 10 * 60  # seconds between fingerprint checks of a built summary
+
+_lock = threading.Lock()
+jobs = {}  # (repo, graph) to status dict of builds running in this process
+checked = {}  # (repo, graph) to time of the last fingerprint check
+
+
+def lock_path(repo, graph):
+    return summary.summary_path(repo, graph) + '.lock'
+
+
+def status_path(repo, graph):
+    return summary.summary_path(repo, graph) + '.status'
+
+
+def _write_status(repo, graph, status):
+    path = status_path(repo, graph)
+    tmp_path = '%s.tmp-%d' % (path, os.getpid())
+    with open(tmp_path, 'w') as f:
+        json.dump(status, f)
+    os.replace(tmp_path, path)
+
+
+def _read_status(repo, graph):
+    try:
+        with open(status_path(repo, graph)) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _acquire_lock(repo, graph):
+    """
+    Take the cross-process build lock; stale locks (dead owner or too old) are taken over.
+    """
+    path = lock_path(repo, graph)
+    for _ in range(2):
+        try:
+            fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            try:
+                with open(path) as f:
+                    pid = int(f.read().split()[0])
+                age = time.time() - os.path.getmtime(path)
+            except (OSError, ValueError, IndexError):
+                return False
+            if _pid_alive(pid) and age < lock_timeout:
+                return False
+            print('Removing stale summary build lock', path)
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            continue
+        with os.fdopen(fd, 'w') as f:
+            f.write('%d %f' % (os.getpid(), time.time()))
+        return True
+    return False
+
+
+def status(repo, graph):
+    key = (repo, graph or None)
+    if key in jobs:
+        return dict(jobs[key])
+    status = _read_status(repo, graph)
+    if status:
+        return status
+    return {'state': 'done' if os.path.isfile(summary.summary_path(repo, graph)) else 'missing'}
+
+
+def _sparql(repo):
+    # builds run next to request threads, so they get a store of their own
+    return SPARQLStore(setting.endpoint + '/' + repo)
+
+
+def ensure(repo, graph, namespaces, AIDA):
+    """
+    Return True if the summary of (repo, graph) is ready. Otherwise make sure
+    exactly one background build is running for it and return False.
+    """
+    path = summary.summary_path(repo, graph)
+    if os.path.isfile(path):
+        return True
+
+    key = (repo, graph or None)
+    with _lock:
+        if key in jobs:
+            return False
+        previous = _read_status(repo, graph)
+        if previous and previous.get('state') == 'failed' and time.time() - previous.get('updated', 0) < retry_delay:
+            return False
+        os.makedirs(summary.summary_dir, exist_ok=True)
+        if not _acquire_lock(repo, graph):
+            return False  # another process is building it
+        if os.path.isfile(path):  # finished while we were taking the lock
+            os.remove(lock_path(repo, graph))
+            return True
+        # a legacy pickle is converted instead of queried, but off the request thread as well
+        mode = 'legacy' if os.path.isfile(summary.legacy_path(repo, graph)) else 'full'
+        jobs[key] = {'state': 'building', 'mode': mode, 'stage': 'starting',
+                     'started': time.time(), 'updated': time.time()}
+
+    _start(repo, graph, namespaces, AIDA)
+    return False
+
+
+def refresh_if_stale(repo, graph, namespaces, AIDA, force=False):
+    """
+    At most every check_interval seconds, compare the graph fingerprint with the
+    one recorded in the summary and, if it changed, merge a delta into it in the
+    background. `force` checks now and merges a delta even if the fingerprint is
+    unchanged. The current summary keeps being served meanwhile.
+    """
+    key = (repo, graph or None)
+    with _lock:
+        if key in jobs or (not force and time.time() - checked.get(key, 0) < check_interval):
+            return False
+        checked[key] = time.time()
+        if not os.path.isfile(summary.summary_path(repo, graph)) or not _acquire_lock(repo, graph):
+            return False
+        jobs[key] = {'state': 'checking', 'mode': 'delta', 'stage': 'fingerprint', 'force': force,
+                     'started': time.time(), 'updated': time.time()}
+
+    _start(repo, graph, namespaces, AIDA)
+    return True
+
+
+def _start(repo, graph, namespaces, AIDA):
+    thread = threading.Thread(target=_build, args=(repo, graph, namespaces, AIDA),
+                              name='summary-build-' + summary.summary_id(repo, graph), daemon=True)
+    thread.start()
+
+
+def _build(repo, graph, namespaces, AIDA):
+    key = (repo, graph or None)
+    job = jobs[key]
+    path = summary.summary_path(repo, graph)
+    build_path = path + '.build'
+    sparql = _sparql(repo)
+
+    def progress(stage, done=None, total=None):
+        job['stage'] = stage
+        job['done'] = done
+        job['total'] = total
+        job['updated'] = time.time()
+        _write_status(repo, graph, job)
+
+    try:
+        if job['mode'] == 'legacy':
+            progress('converting')
+            summary.write_summary(summary.load_legacy(summary.legacy_path(repo, graph)), build_path)
+            os.replace(build_path, path)
+            cache.default.invalidate(cache.scope(repo, graph))
+            job['state'] = 'done'
+            print('Converted legacy cluster summary', path, 'in %.1fs' % (time.time() - job['started']))
+            return
+        progress('fingerprint')
+        fingerprint = tmp.fingerprint(sparql, graph, namespaces)
+        if job['mode'] == 'delta':
+            current = summary.load(path)
+            # a forced refresh compares the clusters even if the counts did not change
+            if current.fingerprint == fingerprint and not job.get('force'):
+                job['state'] = 'done'
+                return
+            job['state'] = 'building'
+            data, changed = tmp.delta(sparql, graph, current, namespaces, AIDA, progress)
+            job['changed'] = len(changed)
+        else:
+            data, changed = tmp.collect(sparql, graph, namespaces, AIDA, progress), None
+        time_person_label.enrich(sparql, graph, data, namespaces, changed, progress)
+        summary.write_summary(data, build_path, fingerprint)
+        os.replace(build_path, path)
+        # results cached under the old summary may be stale, even if the fingerprint is unchanged
+        cache.default.invalidate(cache.scope(repo, graph))
+        job['state'] = 'done'
+        print('Built cluster summary', path, '(%s)' % job['mode'], 'in %.1fs' % (time.time() - job['started']))
+    except Exception as e:
+        traceback.print_exc()
+        job['state'] = 'failed'
+        job['error'] = repr(e)
+        if os.path.isfile(build_path):
+            os.remove(build_path)
+    finally:
+        job['updated'] = time.time()
+        _write_status(repo, graph, job)
+        with _lock:
+            jobs.pop(key, None)
+        try:
+            os.remove(lock_path(repo, graph))
+        except FileNotFoundError:
+            pass
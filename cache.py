@@ -0,0 +1,267 @@
+"""
+Caching of SPARQL results. QueryCache keeps materialized results in a bounded
+LRU with per query kind TTLs and, optionally, a bounded sqlite file that
+survives restarts; CachedStore wraps a store's query method with it. The
+results of a graph are invalidated when its summary is rebuilt.
+"""
+from collections import OrderedDict
+import hashlib
+import pickle
+import re
+import sqlite3
+import threading
+import time
+from rdflib.query import ResultRow
+from rdflib.term import Variable
+import setting
+
+# seconds a result stays valid, per query kind; entries are also keyed on the graph fingerprint
+ttls = {
+    'ask': 24 * 60 * 60,
+    'select': 60 * 60,
+}
+_kind = re.compile(r'^\s*(?:(?:PREFIX\s+\S*\s*<[^>]*>|BASE\s*<[^>]*>)\s*)*(ASK|SELECT)\b', re.IGNORECASE)
+
+
+class LRUCache:
+    """
+    Thread-safe LRU of at most maxsize entries, each expiring after its ttl (seconds).
+    """
+    def __init__(self, maxsize=10000, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.__lock = threading.Lock()
+        self.__entries = OrderedDict()  # key to (expires, value)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def get(self, key, default=None):
+        with self.__lock:
+            entry = self.__entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            expires, value = entry
+            if expires is not None and expires < time.time():
+                del self.__entries[key]
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self.__entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        with self.__lock:
+            self.__entries[key] = (time.time() + ttl if ttl is not None else None, value)
+            self.__entries.move_to_end(key)
+            while len(self.__entries) > self.maxsize:
+                self.__entries.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, key):
+        with self.__lock:
+            self.__entries.pop(key, None)
+
+    def discard_prefix(self, prefix):
+        with self.__lock:
+            for key in [key for key in self.__entries if key.startswith(prefix)]:
+                del self.__entries[key]
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+    def stats(self):
+        with self.__lock:
+            return {
+                'entries': len(self.__entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
+
+
+class DiskTier:
+    """
+    sqlite table of pickled results, consulted on memory misses. Once it holds
+    more than max_rows results, those expiring first are deleted.
+    """
+    prune_every = 100  # writes between two checks of the row count
+
+    def __init__(self, path, max_rows=None):
+        self.path = path
+        self.max_rows = max_rows
+        self.__lock = threading.Lock()
+        self.__db = sqlite3.connect(path, check_same_thread=False)
+        self.__writes = 0
+        with self.__lock, self.__db:
+            self.__db.execute('CREATE TABLE IF NOT EXISTS results (key TEXT PRIMARY KEY, expires REAL, value BLOB)')
+            self.__prune()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __prune(self):
+        # called with the lock held, in a transaction
+        self.__db.execute('DELETE FROM results WHERE expires < ?', (time.time(),))
+        if self.max_rows is None:
+            return 0
+        entries, = self.__db.execute('SELECT COUNT(*) FROM results').fetchone()
+        if entries <= self.max_rows:
+            return 0
+        self.__db.execute('DELETE FROM results WHERE key IN (SELECT key FROM results ORDER BY expires LIMIT ?)',
+                          (entries - self.max_rows,))
+        return entries - self.max_rows
+
+    def get(self, key):
+        with self.__lock:
+            row = self.__db.execute('SELECT expires, value FROM results WHERE key = ?', (key,)).fetchone()
+            if row is None or row[0] < time.time():
+                self.misses += 1
+                return None
+            self.hits += 1
+        return pickle.loads(row[1])
+
+    def put(self, key, value, ttl):
+        blob = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.__lock, self.__db:
+            self.__db.execute('INSERT OR REPLACE INTO results VALUES (?, ?, ?)', (key, time.time() + ttl, blob))
+            self.__writes += 1
+            if self.__writes % self.prune_every == 0:
+                self.evictions += self.__prune()
+
+    def discard_prefix(self, prefix):
+        # keys start with a hex digest, so the prefix holds no LIKE wildcards
+        with self.__lock, self.__db:
+            self.__db.execute('DELETE FROM results WHERE key LIKE ?', (prefix + '%',))
+
+    def clear(self):
+        with self.__lock, self.__db:
+            self.__db.execute('DELETE FROM results')
+
+    def stats(self):
+        with self.__lock:
+            entries, = self.__db.execute('SELECT COUNT(*) FROM results').fetchone()
+            return {'entries': entries, 'max_rows': self.max_rows, 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
+
+
+def scope(repo, graph):
+    """
+    What the results of a model are cached under: the endpoint, repo and graph.
+    """
+    return setting.endpoint + '/' + repo + '#' + (graph or '')
+
+
+def _prefix(endpoint):
+    return hashlib.sha1(endpoint.encode('utf-8')).hexdigest()[:16] + ':'
+
+
+class QueryCache:
+    def __init__(self, maxsize=10000, disk_path=None, disk_rows=None):
+        self.memory = LRUCache(maxsize)
+        self.disk = DiskTier(disk_path, disk_rows) if disk_path else None
+
+    @staticmethod
+    def kind(query):
+        match = _kind.match(query)
+        return match.group(1).lower() if match else None
+
+    @staticmethod
+    def key(endpoint, fingerprint, query, initNs, initBindings):
+        text = ' '.join(query.split())
+        ns = sorted((str(k), str(v)) for k, v in (initNs or {}).items())
+        bindings = sorted((str(k), v.n3()) for k, v in (initBindings or {}).items())
+        raw = repr((endpoint, fingerprint, text, ns, bindings))
+        # prefixed with the endpoint, so that its results can be invalidated together
+        return _prefix(endpoint) + hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key):
+        value = self.memory.get(key)
+        if value is None and self.disk:
+            value = self.disk.get(key)
+            if value is not None:
+                self.memory.put(key, value, ttls.get(value[0]))
+        return value
+
+    def put(self, key, value):
+        ttl = ttls[value[0]]
+        self.memory.put(key, value, ttl)
+        if self.disk:
+            self.disk.put(key, value, ttl)
+
+    def invalidate(self, endpoint=None):
+        """
+        Drop the results of the endpoint (a scope), or all results. Other processes
+        sharing the disk tier keep their memory tier until its entries expire.
+        """
+        if endpoint is None:
+            self.memory.clear()
+            if self.disk:
+                self.disk.clear()
+            return
+        self.memory.discard_prefix(_prefix(endpoint))
+        if self.disk:
+            self.disk.discard_prefix(_prefix(endpoint))
+
+    def stats(self):
+        stats = {'memory': self.memory.stats()}
+        if self.disk:
+            stats['disk'] = self.disk.stats()
+        return stats
+
+
+def _materialize(kind, result):
+    if kind == 'ask':
+        return kind, bool(result.askAnswer)
+    names = [str(v) for v in result.vars]
+    return kind, names, [tuple(row) for row in result]
+
+
+def _rows(value):
+    if value[0] == 'ask':
+        return [value[1]]
+    _, names, rows = value
+    labels = [Variable(name) for name in names]
+    return [ResultRow({label: term for label, term in zip(labels, row) if term is not None}, labels)
+            for row in rows]
+
+
+class CachedStore:
+    """
+    A store whose ASK and SELECT results are served from a QueryCache.
+    Results are keyed on the endpoint, the graph fingerprint, the normalized
+    query text, the namespaces and the initial bindings; other queries go
+    straight to the store.
+    """
+    def __init__(self, store, endpoint, fingerprint=None, results=None):
+        self.store = store
+        self.endpoint = endpoint
+        self.fingerprint = fingerprint
+        self.results = results or default
+
+    def query(self, query, initNs=None, initBindings=None, **kwargs):
+        kind = QueryCache.kind(query)
+        initNs, initBindings = initNs or {}, initBindings or {}
+        if kind not in ttls or kwargs:
+            return self.store.query(query, initNs, initBindings, **kwargs)
+        key = QueryCache.key(self.endpoint, self.fingerprint, query, initNs, initBindings)
+        value = self.results.get(key)
+        if value is None:
+            value = _materialize(kind, self.store.query(query, initNs, initBindings))
+            self.results.put(key, value)
+        return _rows(value)
+
+    def __getattr__(self, name):
+        return getattr(self.store, name)
+
+
+default = QueryCache(setting.query_cache_size, setting.query_cache_path, setting.query_cache_disk_rows)
@@ -1,40 +1,199 @@
-import json_lines
-import re
+from array import array
+import json
 import os
+import re
+import threading
+import time
+import cache
+import setting
+import store
 
-debugs = {}  # rep/graph to its raw debug data
-debugs_cache = {}
+# debug files can be several gigabytes: records are found through an index of
+# member uri to the byte offset of its record, kept next to the .jl file
+index_version = 1
+records = cache.LRUCache(setting.debug_cache_size)  # (did, stamp, offset) to parsed record
+_indexes = {}  # did to DebugIndex
+_lock = threading.Lock()
+_build_locks = {}
 
 
-def has_debug(repo, graph):
+def debug_id(repo, graph):
     did = repo
     if graph:
         did = repo + '-' + re.sub('[^0-9a-zA-Z]+', '-', graph)
+    return did
 
-    debug_file = 'debug/' + did + '.jl'
-    return os.path.isfile(debug_file)
 
+def debug_path(did):
+    return setting.debug_data + '/' + did + '.jl'
 
-def get_debug_for_cluster(repo, graph, cluster_uri):
 
-    did = repo
-    if graph:
-        did = repo + '-' + re.sub('[^0-9a-zA-Z]+', '-', graph)
+def index_path(did):
+    return debug_path(did) + '.idx'
 
-    # get debug file for repo/graph if hasn't been loaded
-    if did not in debugs:
-        debugs[did] = []
-        debug_file = 'debug/' + did + '.jl'
-        if os.path.isfile(debug_file):
-            with open(debug_file, 'r') as f:
-                for line in json_lines.reader(f):
-                    debugs[did].append(line)
-        else:
-            return None
 
-    entity_uri = cluster_uri.replace('-cluster', '')
-    for debug in debugs[did]:
-        if entity_uri in debug['all_records']:
-            return debug
-    return None  # not found
+def has_debug(repo, graph):
+    return os.path.isfile(debug_path(debug_id(repo, graph)))
+
+
+def _stamp(path):
+    st = os.stat(path)
+    return [st.st_mtime_ns, st.st_size]
+
+
+class IndexWriter:
+    """
+    Collects (member uri, record offset) pairs; the first record of a member wins.
+    """
+    def __init__(self):
+        self.offsets = {}
+        self.count = 0
+
+    def add(self, record, offset):
+        for uri in record['all_records']:
+            self.offsets.setdefault(uri, offset)
+        self.count += 1
+
+    def write(self, path, source_stamp):
+        keys = sorted(self.offsets, key=lambda u: u.encode('utf-8'))
+        sections = {'offsets': array('Q', (self.offsets[k] for k in keys))}
+        store.write_strings(sections, 'keys', keys)
+        meta = {'version': index_version, 'records': self.count, 'source': source_stamp}
+        store.write(path, meta, sections)
+
+
+class DebugIndex:
+    def __init__(self, path):
+        self.__packed = packed = store.Packed(path)
+        self.meta = packed.meta
+        self.__keys = packed.strings('keys')
+        self.__offsets = packed.array('offsets')
+
+    @property
+    def source(self):
+        return self.meta.get('source')
+
+    def find(self, uri):
+        i = self.__keys.find(uri)
+        return self.__offsets[i] if i >= 0 else -1
 
+
+def build_index(did):
+    """
+    Scan the debug file once and write its member index.
+    """
+    path = debug_path(did)
+    stamp = _stamp(path)
+    writer = IndexWriter()
+    with open(path, 'rb') as f:
+        offset = 0
+        for line in f:
+            if line.strip():
+                writer.add(json.loads(line), offset)
+            offset += len(line)
+    writer.write(index_path(did), stamp)
+    print('Indexed debug file', path, '(%d records, %d members)' % (writer.count, len(writer.offsets)))
+
+
+def _build_lock(did):
+    with _lock:
+        if did not in _build_locks:
+            _build_locks[did] = threading.Lock()
+        return _build_locks[did]
+
+
+def _usable(index, did):
+    try:
+        return index.meta.get('version') == index_version and index.source == _stamp(debug_path(did))
+    except OSError:
+        return False
+
+
+def get_index(did):
+    """
+    The member index of a debug file, built on first use or when the file changed.
+    """
+    index = _indexes.get(did)
+    if index is not None and _usable(index, did):
+        return index
+    with _build_lock(did):
+        index = _indexes.get(did)
+        if index is not None and _usable(index, did):
+            return index
+        if os.path.isfile(index_path(did)):
+            index = DebugIndex(index_path(did))
+        if index is None or not _usable(index, did):
+            build_index(did)
+            index = DebugIndex(index_path(did))
+        _indexes[did] = index
+        return index
+
+
+def ingest(repo, graph, stream):
+    """
+    Store an uploaded debug file: records are validated, written and indexed in
+    one pass, then the file, its index and the loaded index are replaced together.
+    Raises ValueError for an invalid record; the current file is kept then.
+    """
+    started = time.time()
+    did = debug_id(repo, graph)
+    os.makedirs(setting.debug_data, exist_ok=True)
+    path = debug_path(did)
+    tmp_path = '%s.upload-%d-%d' % (path, os.getpid(), threading.get_ident())
+    writer = IndexWriter()
+    try:
+        with open(tmp_path, 'wb') as f:
+            offset = 0
+            for n, line in enumerate(stream, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError as e:
+                    raise ValueError('line %d is not valid JSON: %s' % (n, e))
+                if not isinstance(record, dict) or not isinstance(record.get('all_records'), dict):
+                    raise ValueError('line %d has no all_records object' % n)
+                line = line.rstrip(b'\r\n') + b'\n'
+                writer.add(record, offset)
+                f.write(line)
+                offset += len(line)
+
+        # readers wait on the build lock while the file and its index are swapped
+        with _build_lock(did):
+            stamp = _stamp(tmp_path)
+            writer.write(index_path(did) + '.upload', stamp)
+            os.replace(tmp_path, path)
+            os.replace(index_path(did) + '.upload', index_path(did))
+            _indexes[did] = DebugIndex(index_path(did))
+    finally:
+        for leftover in (tmp_path, index_path(did) + '.upload'):
+            if os.path.isfile(leftover):
+                os.remove(leftover)
+
+    status = {'records': writer.count, 'members': len(writer.offsets), 'seconds': round(time.time() - started, 3)}
+    print('Imported debug file', path, status)
+    return status
+
+
+def read_record(did, offset, stamp=None):
+    key = (did, tuple(stamp or ()), offset)
+    record = records.get(key)
+    if record is None:
+        with open(debug_path(did), 'rb') as f:
+            f.seek(offset)
+            record = json.loads(f.readline())
+        records.put(key, record)
+    return record
+
+
+def get_debug_for_cluster(repo, graph, cluster_uri):
+    did = debug_id(repo, graph)
+    if not os.path.isfile(debug_path(did)):
+        return None
+
+    index = get_index(did)
+    entity_uri = cluster_uri.replace('-cluster', '')
+    offset = index.find(entity_uri)
+    if offset < 0:
+        return None  # not found
+    return read_record(did, offset, index.source)
@@ -2,8 +2,8 @@ from rdflib.namespace import split_uri
 from typing import List
 from model import SuperEdge, AIDA
 import uuid
-import subprocess
 import pickle
+import render
 
 SVG = 'SVG'
 PNG = 'PNG'
@@ -32,16 +32,12 @@ class Graph:
         edge_string = [x.to_draw() for x in self.edges]
         return self.generate(node_strings, edge_string)
 
-    def dot(self, format=SVG, path='static/img/'):
-        prefix = path + self.name
-        dotpath = prefix + '.dot'
-        with open(dotpath, 'w') as f:
-            f.write(self.to_draw())
-        imgpath = prefix+'.'+format.lower()
-        e = subprocess.call(
-            ['dot', '-T' + format.lower(), '-o', imgpath, dotpath, '-Ksfdp', '-Goverlap=prism', '-Goverlap_scaling=5',
-             '-Gsep=+20'])
-        print(e)
+    def dot(self, format=SVG, path=render.img_dir):
+        """
+        Queue the render of the graph; returns the image path, written once the render is done.
+        """
+        imgpath = path + self.name + '.' + format.lower()
+        render.renderer.submit(imgpath, self.to_draw(), format.lower())
         return imgpath
 
 
@@ -191,7 +187,7 @@ class SuperEdgeBasedGraph(ClusterGraph):
     @staticmethod
     def _cluster_node_from_pickle(model, uri):
         try:
-            c = model.pickled[str(uri)] #clusters[str(uri)]
+            c = model.summary[str(uri)]
             if c['type'] != AIDA.Relation:
                 return ClusterNode(uri, c['size'], c['label'], type_=c['type'])
             else:
@@ -1,38 +1,119 @@
+from array import array
 import json_lines
 import os
 import re
+import sys
+import threading
 
-# a list of lists
-groundtruth = {}
 prefix = 'http://www.isi.edu/gaia/entities/'
 
+# gtid to GroundtruthIndex
+groundtruth = {}
+_lock = threading.Lock()
+_load_locks = {}
+
 
-def has_gt(repo, graph):
+def gt_id(repo, graph):
     gtid = repo
     if graph:
         gtid = gtid + repo + '-' + re.sub('[^0-9a-zA-Z]+', '-', graph)
-    file = 'gt/' + gtid + 'jl'
-    return os.path.isfile(file)
+    return gtid
 
 
-# returns a list of members in the gt cluster
-def search_cluster(repo, graph, entity_uri):
-    gtid = repo
-    if graph:
-        gtid = gtid + repo + '-' + re.sub('[^0-9a-zA-Z]+', '-', graph)
+def gt_file(gtid):
+    return 'gt/' + gtid + 'jl'
+
+
+def has_gt(repo, graph):
+    return os.path.isfile(gt_file(gt_id(repo, graph)))
+
+
+class GroundtruthIndex:
+    """
+    Ground-truth clusters of one file. Entities are numbered once (uris without
+    the common prefix are stored a single time), clusters are runs of entity
+    numbers in one array, and every entity maps to its first cluster.
+    """
+    def __init__(self, clusters):
+        self.__ids = {}  # uri (without prefix) to entity number
+        self.__uris = []
+        self.__prefixed = array('b')  # whether the entity's uri starts with prefix
+        self.__cluster_of = array('i')  # entity number to cluster number
+        self.__members = array('I')  # entity numbers of all clusters, one run per cluster
+        self.__offsets = array('I', [0])
+        for cluster in clusters:
+            for uri in cluster:
+                entity = self.__entity(uri)
+                if self.__cluster_of[entity] < 0:
+                    self.__cluster_of[entity] = len(self.__offsets) - 1
+                self.__members.append(entity)
+            self.__offsets.append(len(self.__members))
+
+    def __entity(self, uri):
+        key = uri[len(prefix):] if uri.startswith(prefix) else uri
+        entity = self.__ids.get(key)
+        if entity is None:
+            entity = self.__ids[key] = len(self.__uris)
+            self.__uris.append(key)
+            self.__prefixed.append(uri.startswith(prefix))
+            self.__cluster_of.append(-1)
+        return entity
 
+    def __uri(self, entity):
+        return prefix + self.__uris[entity] if self.__prefixed[entity] else self.__uris[entity]
+
+    def __len__(self):
+        return len(self.__offsets) - 1
+
+    def cluster(self, i):
+        return [self.__uri(e) for e in self.__members[self.__offsets[i]:self.__offsets[i + 1]]]
+
+    def search(self, entity_uri):
+        key = entity_uri[len(prefix):] if entity_uri.startswith(prefix) else entity_uri
+        entity = self.__ids.get(key)
+        if entity is None:
+            return []
+        return self.cluster(self.__cluster_of[entity])
+
+    def clusters(self):
+        return [self.cluster(i) for i in range(len(self))]
+
+    def stats(self):
+        size = sys.getsizeof(self.__ids) + sys.getsizeof(self.__uris) + sum(sys.getsizeof(u) for u in self.__uris)
+        for a in (self.__prefixed, self.__cluster_of, self.__members, self.__offsets):
+            size += a.buffer_info()[1] * a.itemsize
+        return {'clusters': len(self), 'entities': len(self.__uris), 'bytes': size}
+
+
+def _load_lock(gtid):
+    with _lock:
+        if gtid not in _load_locks:
+            _load_locks[gtid] = threading.Lock()
+        return _load_locks[gtid]
+
+
+def get_index(repo, graph):
+    """
+    The index of (repo, graph), loaded on first use; concurrent first requests share one load.
+    """
+    gtid = gt_id(repo, graph)
     if gtid not in groundtruth:
-        file = 'gt/' + gtid + 'jl'
-        groundtruth[gtid] = []
-        with open(file, 'r') as f:
-            for line in json_lines.reader(f):
-                groundtruth[gtid].append(line)
+        with _load_lock(gtid):
+            if gtid not in groundtruth:
+                with open(gt_file(gtid), 'r') as f:
+                    groundtruth[gtid] = GroundtruthIndex(json_lines.reader(f))
+                print('Loaded ground truth', gtid, groundtruth[gtid].stats())
+    return groundtruth[gtid]
 
-    for cluster in groundtruth[gtid]:
-        if entity_uri in cluster:
-            return cluster
-    return []
+
+# returns a list of members in the gt cluster
+def search_cluster(repo, graph, entity_uri):
+    return get_index(repo, graph).search(entity_uri)
 
 
 def get_all():
-    return groundtruth
+    return {gtid: index.clusters() for gtid, index in list(groundtruth.items())}
+
+
+def stats():
+    return {gtid: index.stats() for gtid, index in list(groundtruth.items())}
@@ -0,0 +1,209 @@
+"""
+Rendered neighborhood images, addressed by the content they show.
+
+An image is named by the hash of its repo, graph and DOT text, so an unchanged
+neighborhood is served from the cache, a changed one is rendered afresh, and
+clusters of different repos never share an image. Every image has a metadata
+file (<name>.json) describing it; the cache keeps the images of the last
+setting.image_cache_bytes bytes used, and stale ones can be pruned with
+
+    python image_cache.py [--repo <repo>] [--graph <graph>] [--days <age>]
+"""
+from collections import OrderedDict
+import argparse
+import hashlib
+import json
+import os
+import threading
+import time
+import render
+import setting
+
+
+def key(repo, graph, dot):
+    """
+    Name of the image of the DOT text. Lines are hashed in sorted order: the
+    order of nodes and edges in the text is arbitrary, not part of the content.
+    """
+    h = hashlib.sha1()
+    for part in (repo, graph or ''):
+        h.update(part.encode('utf-8') + b'\0')
+    h.update('\n'.join(sorted(dot.splitlines())).encode('utf-8'))
+    return h.hexdigest()
+
+
+class ImageCache:
+    def __init__(self, directory, max_bytes, format='svg'):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.format = format
+        self.__lock = threading.Lock()
+        self.__entries = OrderedDict()  # name to bytes on disk, least recently used first
+        self.__bytes = 0
+        self.__counters = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self.__entries, self.__bytes = self.__scan()
+
+    def __files(self, name):
+        prefix = os.path.join(self.directory, name)
+        return prefix + '.' + self.format, prefix + '.dot', prefix + '.json'
+
+    def __size(self, name):
+        size = 0
+        for file in self.__files(name)[:2]:
+            try:
+                size += os.path.getsize(file)
+            except OSError:
+                pass
+        return size
+
+    def __scan(self):
+        # entries are the images with metadata, ordered by when they were last served
+        # (served images are touched, so the order holds across processes)
+        entries, total = OrderedDict(), 0
+        if not os.path.isdir(self.directory):
+            return entries, total
+        found = []
+        for file in os.listdir(self.directory):
+            name, ext = os.path.splitext(file)
+            try:
+                if ext == '.json':
+                    found.append((os.path.getmtime(self.__files(name)[0]), name))
+            except OSError:
+                continue  # no image, or removed meanwhile
+        for _, name in sorted(found):
+            size = self.__size(name)
+            entries[name] = size
+            total += size
+        return entries, total
+
+    def path(self, name):
+        return self.__files(name)[0]
+
+    def meta(self, name):
+        try:
+            with open(self.__files(name)[2]) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def hit(self, name):
+        """
+        Whether the image is cached; a cached image becomes the most recently used.
+        Images recorded by other processes sharing the directory are cached too.
+        """
+        with self.__lock:
+            known = name in self.__entries
+            if known:
+                self.__entries.move_to_end(name)
+        if not known and not os.path.isfile(self.__files(name)[2]):
+            with self.__lock:
+                self.__counters['misses'] += 1
+            return False
+        try:
+            os.utime(self.path(name))
+        except OSError:
+            # evicted or pruned by another process: render it again
+            with self.__lock:
+                self.__bytes -= self.__entries.pop(name, 0)
+                self.__counters['misses'] += 1
+            return False
+        size = self.__size(name) if not known else None
+        with self.__lock:
+            if name not in self.__entries and size is not None:
+                self.__entries[name] = size
+                self.__bytes += size
+            self.__counters['hits'] += 1
+        return True
+
+    def add(self, name, meta):
+        """
+        Record a rendered image with its metadata, then evict the least recently
+        used images beyond max_bytes. Processes sharing the directory share the
+        bound: the usage is recounted from the directory itself.
+        """
+        meta = dict(meta, created=time.time())
+        render.write_atomic(self.__files(name)[2], json.dumps(meta))
+        # a directory listing costs little next to the render that preceded it
+        entries, total = self.__scan()
+        with self.__lock:
+            self.__entries, self.__bytes = entries, total
+            if name in self.__entries:
+                self.__entries.move_to_end(name)
+            evicted = []
+            while self.__bytes > self.max_bytes and len(self.__entries) > 1:
+                old, old_size = self.__entries.popitem(last=False)
+                self.__bytes -= old_size
+                evicted.append(old)
+            self.__counters['evictions'] += len(evicted)
+        for old in evicted:
+            self.__remove(old)
+
+    def __remove(self, name):
+        # the metadata goes first: an image without it is no longer an entry
+        for file in reversed(self.__files(name)):
+            try:
+                os.remove(file)
+            except OSError:
+                pass
+
+    def prune(self, repo=None, graph=None, max_age=None):
+        """
+        Remove the images of a repo (and graph), or those created more than
+        max_age seconds ago. Returns the number of images removed.
+        """
+        with self.__lock:
+            names = list(self.__entries)
+        removed = 0
+        for name in names:
+            meta = self.meta(name) or {}
+            if repo is not None and meta.get('repo') != repo:
+                continue
+            if graph is not None and meta.get('graph') != graph:
+                continue
+            if max_age is not None and time.time() - meta.get('created', 0) < max_age:
+                continue
+            with self.__lock:
+                self.__bytes -= self.__entries.pop(name, 0)
+            self.__remove(name)
+            removed += 1
+        return removed
+
+    def stats(self):
+        with self.__lock:
+            return dict(self.__counters, entries=len(self.__entries), bytes=self.__bytes, max_bytes=self.max_bytes)
+
+
+images = ImageCache(render.img_dir, setting.image_cache_bytes)
+
+
+def image(repo, graph, dot, cluster=None, fingerprint=None, truncated=False):
+    """
+    Name of the image of the DOT text, queued for rendering unless it is cached
+    or already rendering. `truncated` records that the graph was cut at a budget.
+    """
+    name = key(repo, graph, dot)
+    path = images.path(name)
+    if images.hit(name) or render.renderer.status(path) == render.PENDING:
+        return name
+    meta = {'repo': repo, 'graph': graph, 'cluster': cluster, 'fingerprint': fingerprint, 'truncated': truncated}
+
+    def rendered(job):
+        if not job.cancelled() and job.result():
+            images.add(name, meta)
+    render.renderer.submit(path, dot, images.format).add_done_callback(rendered)
+    return name
+
+
+def stats():
+    return images.stats()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Prune cached neighborhood images.')
+    parser.add_argument('--repo', help='only images of this repository')
+    parser.add_argument('--graph', help='only images of this graph')
+    parser.add_argument('--days', type=float, help='only images created more than this many days ago')
+    # without options every cached image is removed
+    args = parser.parse_args()
+    max_age = args.days * 24 * 60 * 60 if args.days is not None else None
+    print('Removed %d images from %s' % (images.prune(args.repo, args.graph, max_age), images.directory))
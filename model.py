@@ -1,19 +1,19 @@
-from rdflib.plugins.stores.sparqlstore import SPARQLStore
-from source_context import LTFSourceContext
+from source_context import LTFSourceContext, extract_mentions
 from rdflib import URIRef, Literal
 from rdflib.namespace import Namespace, RDF, SKOS, split_uri
-from collections import namedtuple, Counter
-import pickle
-from setting import wikidata_endpoint, groundtruth_url
-import requests
+from collections import namedtuple, Counter, defaultdict
+import setting
 import debug
+import groundtruth
 import json
-import os
-import tmp
-import time_person_label
-import re
+import batching
+import builder
+import cache
+import wikidata
+import image_cache
+import summary
+import source_store
 
-wikidata_sparql = SPARQLStore(wikidata_endpoint)
 AIDA = Namespace('https://tac.nist.gov/tracks/SM-KBP/2019/ontologies/InterchangeOntology#')
 WDT = Namespace('http://www.wikidata.org/prop/direct/')
 namespaces = {
@@ -27,17 +27,18 @@ types = namedtuple('AIDATypes', ['Entity', 'Events', 'Relation'])(AIDA.Entity, A
 
 class Model:
     def __init__(self, sparql, repo, graph):
-        self.__sparql = sparql
         self.__repo = repo
         self.__graph = graph
-        pkl_file = 'pkl/' + repo
-        if graph:
-            pkl_file = pkl_file + '-' + re.sub('[^0-9a-zA-Z]+', '-', graph)
-        pkl_file = pkl_file + '.pkl'
-        if not os.path.isfile(pkl_file):
-            tmp.run(sparql, graph, pkl_file, namespaces, AIDA)
-            time_person_label.run(sparql, graph, pkl_file, namespaces)
-        self.__pickled = pickle.load(open(pkl_file, 'rb'))
+        self.__summary = None
+        # the summary is built in the background on first use; until then the model is not ready
+        if builder.ensure(repo, graph, namespaces, AIDA):
+            self.__summary = summary.registry.get(repo, graph)
+            builder.refresh_if_stale(repo, graph, namespaces, AIDA)
+        # cached results are keyed on the graph fingerprint, so a changed graph is queried afresh
+        fingerprint = self.__summary.fingerprint if self.__summary is not None else None
+        self.__sparql = cache.CachedStore(sparql, cache.scope(repo, graph), fingerprint)
+        # the packed source documents, resolved once for all the mention contexts of this model
+        self.__sources = source_store.source_store()
 
     @property
     def graph(self):
@@ -52,15 +53,63 @@ class Model:
         return self.__sparql
 
     @property
-    def pickled(self):
-        return self.__pickled
+    def summary(self):
+        return self.__summary
+
+    @property
+    def sources(self):
+        return self.__sources
+
+    @property
+    def ready(self):
+        return self.__summary is not None
+
+    @property
+    def build_status(self):
+        return builder.status(self.__repo, self.__graph)
+
+    def refresh(self):
+        return builder.refresh_if_stale(self.__repo, self.__graph, namespaces, AIDA, force=True)
 
     def get_cluster(self, uri):
-        if Cluster.ask(self.__sparql, self.__graph, uri):
-            return Cluster(self, uri)
+        header = Cluster.header(self, uri)
+        if header:
+            return Cluster(self, uri, header)
         return None
 
-    def get_cluster_list(self, type_=None, limit=10, offset=0, sortby='size'):
+    def get_cluster_list(self, type_=None, limit=10, offset=0, sortby='size', after=None):
+        """
+        `after` is a (count, uri) keyset position: only clusters after it in the
+        size order are listed, and `offset` is counted from there.
+        """
+        # entity lists are always by size, and an unknown order is size too
+        if after or type_ == AIDA.Entity or sortby not in ('type', 'label'):
+            sortby = 'size'
+        order = self.__summary.order(type_, sortby) if type_ else None
+        if order is None:
+            yield from self._query_cluster_list(type_, limit, offset, sortby, after)
+            return
+        if after:
+            offset += self.__summary.seek(type_, *after)
+        rows = order[offset:offset + limit] if limit else order[offset:]
+        for i in rows:
+            u, l, c = self.__summary.list_row(i)
+            yield self._cluster_summary(URIRef(u), l, c)
+
+    def _cluster_summary(self, u, l, c):
+        if 'http://www.isi.edu/gaia' in u:
+            href = u.replace('http://www.isi.edu/gaia', '/cluster')
+            href = href.replace('/entities', '/entities/' + self.repo)
+            href = href.replace('/events', '/events/' + self.repo)
+            href = href.replace('/relations', '/relations/' + self.repo)
+        else:
+            href = u.replace('http://www.columbia.edu', '/cluster/' + self.repo)
+        if self.graph:
+            href = href + '?g=' + self.graph
+        return ClusterSummary(u, href, l, c)
+
+    def _query_cluster_list(self, type_=None, limit=10, offset=0, sortby='size', after=None):
+        # used for summaries written before the sorted cluster lists were stored
         open_clause = close_clause = ''
         if self.__graph:
             open_clause = 'GRAPH <%s> {' % self.__graph
@@ -78,8 +127,16 @@ class Model:
         %s
     }
     GROUP BY ?cluster ?label
+    having_clause
     ORDER BY order_by
     """ % (open_clause, close_clause)
+        if after:
+            count, uri = after
+            query = query.replace('having_clause', 'HAVING (COUNT(?member) < %d || (COUNT(?member) = %d && STR(?cluster) > %s))'
+                                  % (count, count, Literal(str(uri)).n3()))
+            query = query.replace('order_by', 'DESC(?memberN) ?cluster')
+        else:
+            query = query.replace('having_clause', '')
         if type_ == AIDA.Entity:
             query = query.replace('?type', type_.n3())
             query = query.replace('label_string', 'OPTIONAL {?prototype aida:hasName ?label} .')
@@ -106,16 +163,7 @@ class Model:
             c = r.memberN
             if isinstance(l, URIRef):
                 _, l = split_uri(l)
-            if 'http://www.isi.edu/gaia' in u:
-                href = u.replace('http://www.isi.edu/gaia', '/cluster')
-                href = href.replace('/entities', '/entities/' + self.repo)
-                href = href.replace('/events', '/events/' + self.repo)
-                href = href.replace('/relations', '/relations/' + self.repo)
-            else:
-                href = u.replace('http://www.columbia.edu', '/cluster/' + self.repo)
-            if self.graph:
-                href = href + '?g=' + self.graph
-            yield ClusterSummary(u, href, l, c)
+            yield self._cluster_summary(u, l, c)
 
     def recover_doc_online(self, doc_id):
         import json
@@ -145,11 +193,12 @@ class Model:
 
 
 class Cluster:
-    def __init__(self, model, uri):
+    def __init__(self, model, uri, header=None):
         self.model = model
         self.uri = URIRef(uri)
         self.__prototype = None
         self.__type = None
+        self.__size = None
         self.__members = []
         self.__forward = None
         self.__backward = None
@@ -163,6 +212,10 @@ class Cluster:
         self.__groundtruth = None
         self.__debug_info = None
         self.__all_labels = None
+        self.__img = None
+        self.neighborhood_truncated = False
+        self.round_trips = 0  # SPARQL queries issued by the member batch loaders
+        self.wikidata_status = None
 
         if model.graph:
             self.__open_clause = 'GRAPH <%s> {' % self.model.graph
@@ -170,6 +223,25 @@ class Cluster:
         else:
             self.__open_clause = self.__close_clause = ''
 
+        if header:
+            prototype, label, type_ = header['prototype']
+            if prototype:
+                self.__prototype = ClusterMember(self.model, prototype, label, type_)
+            self.__type = header['category']
+            self.__size = header['size']
+
+    def prefetch_members(self, limit=None):
+        """
+        Load what cluster.html shows for the members (the first `limit` of them,
+        labels for all) with a few batched queries instead of per-member queries.
+        """
+        members = self.members
+        shown = members[:limit] if limit else members
+        fields = {'source'} | ({'roles'} if 'Event' in self.prototype.type else {'events', 'relations'})
+        self.round_trips += ClusterMember.prefetch(self.model, members, {'labels'})
+        self.round_trips += ClusterMember.prefetch(self.model, shown, fields)
+        ClusterMember.prefetch_mentions(shown)
+
     @property
     def href(self):
         res = self.uri.replace('http://www.isi.edu/gaia', '/cluster').replace('http://www.columbia.edu', '/cluster')
@@ -181,13 +253,14 @@ class Cluster:
 
     @property
     def label(self):
-        if self.uri in self.model.pickled and 'label' in self.model.pickled[self.uri]:
-            return self.model.pickled[self.uri]['label']
+        label = self.model.summary.label(self.uri)
+        if label is not None:
+            return label
         return self.prototype.label
 
     @property
     def all_labels(self):
-        if not self.__all_labels:
+        if self.__all_labels is None:
             self.__all_labels = Counter()
             for m in self.members:
                 for l, c in m.all_labels:
@@ -205,8 +278,9 @@ class Cluster:
 
     @property
     def type(self):
-        if self.uri in self.model.pickled and 'type' in self.model.pickled[self.uri]:
-            return self.model.pickled[self.uri]['type']
+        type_ = self.model.summary.type(self.uri)
+        if type_ is not None:
+            return type_
         if not self.__type:
             self._init_cluster_prototype()
         return self.__type
@@ -235,7 +309,7 @@ class Cluster:
     @property
     def target_wiki(self):
         if self.__target_wiki is None:
-            self._init_cluster_members()
+            self._init_wikidata()
         return self.__target_wiki
 
     @property
@@ -250,8 +324,8 @@ class Cluster:
 
     @property
     def qids(self):
-        if not self.__qids:
-            self._init_qnodes()
+        if self.__target_wiki is None:
+            self._init_wikidata()
         return self.__qids.most_common()
 
     @property
@@ -268,15 +342,17 @@ class Cluster:
 
     @property
     def q_urls(self):
-        if not self.__q_urls:
-            self._init_qnodes()
+        if self.__target_wiki is None:
+            self._init_wikidata()
         return self.__q_urls
 
     @property
     def size(self):
         if self.__members:
             return len(self.__members)
-        return self._query_for_size()
+        if self.__size is None:
+            self.__size = self._query_for_size()
+        return self.__size
 
     @property
     def forward(self):
@@ -296,34 +372,187 @@ class Cluster:
     def neighbors(self):
         return self.forward | self.backward
 
-    def neighborhood(self, hop=1):
-        if hop == 1 and self.prototype.type != AIDA.Relation:
-            hood = self.neighbors
-            # for neighbor in [x for x in self.neighbors if x.subject.proto]
-            for neighbor in self.neighbors:
-                if neighbor.subject.prototype.type == AIDA.Relation:
-                    hood |= neighbor.subject.neighbors
-            return hood
-        if hop <= 1:
-            return self.neighbors
+    def neighborhood(self, hop=1, max_nodes=None, max_edges=None):
+        """
+        Super edges within `hop` hops, found breadth first: every frontier is
+        expanded with batched forward and backward queries, and every cluster
+        once. Relations pointing to an expanded non-relation cluster bring their
+        own edges too. Expansion stops when `max_nodes` clusters (relations
+        included) were expanded or `max_edges` edges were found;
+        `neighborhood_truncated` tells.
+        """
+        clusters = {self.uri: self}  # one Cluster per uri, so edges share them
+        visited = {self.uri}
         hood = set()
-        for neighbor in self.neighbors:
-            hood |= neighbor.subject.neighborhood(hop-1)
-            hood |= neighbor.object.neighborhood(hop-1)
+        self.neighborhood_truncated = False
+
+        def add(edges):
+            for edge in edges:
+                if max_edges is not None and len(hood) >= max_edges and edge not in hood:
+                    self.neighborhood_truncated = True
+                    return
+                hood.add(edge)
+                yield edge
+
+        # the edges of the clusters within hop - 1 hops, and of the relations pointing to them
+        frontier = [self]
+        relations = {}
+        for depth in range(max(hop, 1)):
+            next_frontier = []
+            for c in Cluster._expand(self.model, frontier, clusters):
+                extend = hop >= 1 and not c.__is_relation()
+                for edge in add(c.neighbors):
+                    for end in (edge.subject, edge.object):
+                        if end.uri in visited:
+                            continue
+                        if depth < hop - 1:
+                            if max_nodes is not None and len(visited) >= max_nodes:
+                                self.neighborhood_truncated = True
+                                continue
+                            visited.add(end.uri)
+                            next_frontier.append(end)
+                        elif extend and end is edge.subject and end.uri not in relations and end.__is_relation():
+                            # relations expanded at the end count against the same budget
+                            if max_nodes is not None and len(visited) + len(relations) >= max_nodes:
+                                self.neighborhood_truncated = True
+                                continue
+                            relations[end.uri] = end
+            frontier = next_frontier
+            if not frontier:
+                break
+        for r in Cluster._expand(self.model, list(relations.values()), clusters):
+            for _ in add(r.neighbors):
+                pass
         return hood
 
+    def __is_relation(self):
+        kind = self.model.summary.kind(self.uri) if self.model.summary is not None else None
+        if kind is None:
+            return self.prototype.type == AIDA.Relation
+        return kind == str(AIDA.Relation)
+
+    @classmethod
+    def _expand(cls, model, frontier, clusters):
+        """
+        Load the forward and backward edges of the frontier clusters not loaded
+        yet, with one query per batch. Returns the frontier.
+        """
+        pending = {c.uri: c for c in frontier if c.__forward is None or c.__backward is None}
+        if not pending:
+            return frontier
+        for c in pending.values():
+            c.__forward, c.__backward = set(), set()
+        first = frontier[0]
+        query = """
+SELECT ?s ?p ?o ?cnt
+WHERE {
+  { %s } UNION { %s }
+    %s
+  ?s aida:prototype ?proto1 .
+  ?o aida:prototype ?proto2 .
+  ?se rdf:subject ?proto1 ;
+      rdf:predicate ?p ;
+      rdf:object ?proto2 ;
+      aida:confidence/aida:confidenceValue ?conf .
+  BIND(ROUND(1/(2*(1-?conf))) as ?cnt)
+    %s
+} """
+
+        def cluster(uri):
+            if uri not in clusters:
+                clusters[uri] = Cluster(model, uri)
+            return clusters[uri]
+
+        for batch in batching.batches(pending):
+            # one formatting pass: the clauses may hold a '%' of the graph uri
+            batch_query = query % (batching.values('s', batch), batching.values('o', batch),
+                                   first.__open_clause, first.__close_clause)
+            for s, p, o, cnt in model.sparql.query(batch_query, namespaces):
+                edge = SuperEdge(cluster(s), cluster(o), p, int(float(str(cnt))))
+                if s in pending:
+                    pending[s].__forward.add(edge)
+                if o in pending:
+                    pending[o].__backward.add(edge)
+        return frontier
+
     @property
     def img(self):
-        import os.path
-        _, name = split_uri(self.uri)
-        svgpath = 'static/img/' + name + '.svg'
-        if os.path.isfile(svgpath):
-            return name
+        if self.__img is None:
+            from graph import SuperEdgeBasedGraph
+            hood = self.neighborhood(max_nodes=setting.neighborhood_max_nodes,
+                                     max_edges=setting.neighborhood_max_edges)
+            graph = SuperEdgeBasedGraph(self.model, hood, self, self.uri)
+            fingerprint = self.model.summary.fingerprint if self.model.summary is not None else None
+            self.__img = image_cache.image(self.model.repo, self.model.graph, graph.to_draw(),
+                                           str(self.uri), fingerprint, self.neighborhood_truncated)
+        return self.__img
 
-        from graph import SuperEdgeBasedGraph
-        graph = SuperEdgeBasedGraph(self.model, self.neighborhood(), self, self.uri)
-        path = graph.dot()
-        return graph.name
+    @property
+    def img_truncated(self):
+        # whether the graph of img was cut at the neighborhood budgets
+        return self.img is not None and self.neighborhood_truncated
+
+    @classmethod
+    def header(cls, model, uri):
+        """
+        Existence, prototype (uri, label, type), category and size of a cluster,
+        from the summary if it has them, otherwise with a single query.
+        Returns None if there is no such cluster.
+        """
+        record = model.summary.get(uri) if model.summary is not None else None
+        # summaries written before categories were recorded are answered by the query
+        if record and all(k in record for k in ('prototype', 'kind', 'size', 'category')):
+            category = URIRef(record['category']) if record['category'] else None
+            label = record.get('name')
+            if not label and category:
+                try:
+                    _, label = split_uri(category)
+                except ValueError:
+                    label = None
+            return {'prototype': (record['prototype'], label, URIRef(record['kind'])),
+                    'category': category,
+                    'size': record['size']}
+
+        if model.graph:
+            open_clause = 'GRAPH <%s> {' % model.graph
+            close_clause = '}'
+        else:
+            open_clause = close_clause = ''
+        cluster = URIRef(uri).n3()
+        query = """
+SELECT ?prototype (MIN(?label) AS ?mlabel) ?type ?category ?size
+WHERE {
+    %s
+    %s a aida:SameAsCluster .
+    OPTIONAL {
+        %s aida:prototype ?prototype .
+        ?prototype a ?type .
+        OPTIONAL { ?prototype aida:hasName ?label } .
+        OPTIONAL { ?statement a rdf:Statement ;
+                   rdf:subject ?prototype ;
+                   rdf:predicate rdf:type ;
+                   rdf:object ?category ; }
+    }
+    %s
+    {
+        SELECT (COUNT(?member) AS ?size)
+        WHERE {
+            %s
+            ?membership aida:cluster %s ;
+                        aida:clusterMember ?member .
+            MINUS {%s aida:prototype ?member}
+            %s
+        }
+    }
+}
+GROUP BY ?prototype ?type ?category ?size """ % (open_clause, cluster, cluster, close_clause,
+                                                 open_clause, cluster, cluster, close_clause)
+        header = None
+        for prototype, label, type_, cate, size in model.sparql.query(query, namespaces):
+            if not label and cate:
+                _, label = split_uri(cate)
+            header = {'prototype': (prototype, label, type_), 'category': cate, 'size': int(size or 0)}
+        return header
 
     @classmethod
     def ask(cls, sparql, graph, uri):
@@ -379,7 +608,6 @@ GROUP BY ?prototype ?type ?category """ % (self.__open_clause, self.__close_clau
 
     def _init_cluster_members(self):
         self.__targets = Counter()
-        self.__target_wiki = {}
         self.__freebases = Counter()
         query = """
 SELECT ?member (MIN(?label) AS ?mlabel) ?type
@@ -397,77 +625,88 @@ WHERE {
      
 }
 GROUP BY ?member ?type """ % (self.__open_clause, self.__close_clause)
+        debug_info = self.debug_info
         for member, label, type_ in self.model.sparql.query(query, namespaces, {'cluster': self.uri}):
             m = ClusterMember(model=self.model,
                               uri=str(member),
                               label=label,
                               type_=type_,
-                              debug_info=self.debug_info.members[str(member)]['raw_object'])
+                              debug_info=debug_info.members[str(member)]['raw_object'] if debug_info else None)
             self.__members.append(m)
+        self.round_trips += 1 + ClusterMember.prefetch(self.model, self.__members, {'member', 'links'})
+        for m in self.__members:
             for target in m.targets.keys():
                 self.__targets[target] += 1
             for freebase in m.freebases.keys():
                 self.__freebases[freebase] += 1
 
-        query = '''
-SELECT ?qnode ?qnodeLabel 
-WHERE 
-{
-    ?qnode wdt:P1566 ?target .
-    SERVICE wikibase:label { bd:serviceParam wikibase:language "[AUTO_LANGUAGE],en". }
-} '''
-        for target in self.__targets.keys():
-            target_t = target[target.index(':')+1:]
-            for qnode, qnodeLabel in wikidata_sparql.query(query, namespaces, {'target': Literal(target_t)}):
-                url = str(qnode)
-                qnode = url[url.rfind('/')+1:]
-                self.__target_wiki[target] = {}
-                self.__target_wiki[target]['qnode'] = qnode
-                self.__target_wiki[target]['url'] = url
-                self.__target_wiki[target]['label'] = str(qnodeLabel)
-
-    def _init_qnodes(self):
+
+    def wikidata(self, limit=None):
+        """
+        Wikidata sections of the cluster page as a JSON-able dict: the link target
+        qnodes, the cluster qnodes and the qnodes of the first `limit` members.
+        """
+        if self.__target_wiki is None:
+            self._init_wikidata()
+        debug_info = self.debug_info
+        selected = self.selected_qnodes if debug_info else []
+        qnodes = []
+        for qid, count in self.qids:
+            url = self.__q_urls[qid]
+            qnodes.append({'qid': qid, 'url': url, 'count': count, 'selected': url in selected,
+                           'stats': self.get_qnode_stats(url) if debug_info else None})
+        members = {}
+        for m in self.members[:limit] if limit else self.members:
+            members[str(m.uri)] = [{'qid': qid, 'url': m.q_urls[qid], 'score': score,
+                                    'selected': m.q_urls[qid] in selected,
+                                    'label': m.q_labels.get(qid), 'aliases': m.q_aliases.get(qid)}
+                                   for qid, score in (m.qids or {}).items()]
+        return {
+            'status': self.wikidata_status,
+            'targets': self.__target_wiki,
+            'qnodes': qnodes,
+            'members': members,
+        }
+
+    def _init_wikidata(self):
+        # one pass for the link targets and the freebase ids of the cluster and all its members
+        geonames_ids = {target: target[target.index(':')+1:] for target, _ in self.targets}
+        mids = {wikidata.freebase_mid(fbid) for fbid, _ in self.freebases if ":NIL" not in fbid}
+        for m in self.members:
+            mids.update(wikidata.freebase_mid(fbid) for fbid in m.freebases if ":NIL" not in fbid)
+        try:
+            geonames, freebase = wikidata.resolve(geonames_ids.values(), mids, aliases=True)
+            self.wikidata_status = 'ok'
+        except wikidata.Unavailable as e:
+            print('Wikidata unavailable for', self.uri, e)
+            geonames, freebase = {}, {}
+            self.wikidata_status = 'unavailable'
+
+        self.__target_wiki = {}
+        for target, geonames_id in geonames_ids.items():
+            if geonames_id in geonames:
+                self.__target_wiki[target] = geonames[geonames_id][-1]
         for fbid, count in self.freebases:
             if ":NIL" not in fbid:
-                fbid = '/' + fbid.replace('.', '/')
-                query = """
-                    SELECT ?qid ?label WHERE {
-                      ?qid wdt:P646 ?freebase .  
-                      ?qid rdfs:label ?label filter (lang(?label) = "en") .
-                    }
-                    LIMIT 1
-                """
-                for qid, label in wikidata_sparql.query(query, namespaces, {'freebase': Literal(fbid)}):
-                    qnodeURL = str(qid)
-                    qid = qnodeURL.rsplit('/', 1)[1]
-                    self.__qids[qid] = count
-                    if qid not in self.__q_urls:
-                        self.__q_urls[qid] = qnodeURL
+                item = freebase.get(wikidata.freebase_mid(fbid))
+                if item:
+                    self.__qids[item['qid']] = count
+                    if item['qid'] not in self.__q_urls:
+                        self.__q_urls[item['qid']] = item['url']
+        for m in self.members:
+            m._set_qnodes(freebase)
 
     def _init_groundtruth(self):
-        # query to find cluster of the missing member
-        query = '''
-            SELECT ?cluster 
-            WHERE {
-                %s
-                ?membership aida:cluster ?cluster ;
-                aida:clusterMember ?member .
-                %s
-            }
-        ''' % (self.__open_clause, self.__close_clause)
+        if not groundtruth.has_gt(self.model.repo, self.model.graph):
+            self.__groundtruth = False
+            return
 
         member_set = set([str(m.uri) for m in self.members])
         gt_set = set()
         for m in member_set:
-            if self.model.graph:
-                res = requests.get(groundtruth_url + '/' + self.model.repo + '?g=' + self.model.graph + '&e=' + m)
-            else:
-                res = requests.get(groundtruth_url + '/' + self.model.repo + '?e=' + m)
-            if res.status_code == 404:
-                self.__groundtruth = False
-                return
-            if len(res.json()) > 0:
-                gt_set = set(res.json())
+            gt_cluster = groundtruth.search_cluster(self.model.repo, self.model.graph, m)
+            if len(gt_cluster) > 0:
+                gt_set = set(gt_cluster)
                 break
 
         if len(gt_set) > 0:
@@ -476,10 +715,22 @@ WHERE
             missing = gt_set.difference(member_set)
             missing_dict = {}
 
-            if missing:
-                for m in missing:
-                    for c, in self.model.sparql.query(query, namespaces, {'member': URIRef(m)}):
-                        missing_dict[m] = str(c).replace('http://www.isi.edu/gaia/entities/', '')
+            # clusters of the missing members
+            query = '''
+                SELECT ?member ?cluster
+                WHERE {
+                    %s
+                    %s
+                    ?membership aida:cluster ?cluster ;
+                    aida:clusterMember ?member .
+                    %s
+                }
+            '''
+            for batch in batching.batches(missing):
+                values = batching.values('member', batch)
+                for m, c in self.model.sparql.query(query % (values, self.__open_clause, self.__close_clause),
+                                                    namespaces):
+                    missing_dict[str(m)] = str(c).replace('http://www.isi.edu/gaia/entities/', '')
 
             self.__groundtruth = Groundtruth(gt_set, hit, miss, missing_dict)
 
@@ -528,8 +779,9 @@ WHERE {
             self.__backward.add(SuperEdge(Cluster(self.model, s), self, p, int(float(str(cnt)))))
 
     def _query_for_size(self):
-        if self.uri in self.model.pickled and 'size' in self.model.pickled[self.uri]:
-            return self.model.pickled[self.uri]['size']
+        size = self.model.summary.size(self.uri)
+        if size is not None:
+            return size
         query = """
 SELECT (COUNT(?member) AS ?size)
 WHERE {
@@ -580,10 +832,15 @@ class ClusterMember:
         self.__q_aliases = None
         self.__q_urls = None
         self.__source = None
+        self.__source_loaded = False
         self.__context_pos = []
         self.__context_extractor = None
+        self.__mentions = None
         self.__cluster: Cluster = None
         self.__debug_info = debug_info
+        self.__roles = None
+        self.__events_by_role = None
+        self.__entity_relations = None
 
         if model.graph:
             self.__open_clause = 'GRAPH <%s> {' % self.model.graph
@@ -605,7 +862,7 @@ class ClusterMember:
 
     @property
     def all_labels(self):
-        if not self.__all_labels:
+        if self.__all_labels is None:
             self.__all_labels = Counter()
             query = """
                 SELECT ?label (COUNT(?label) AS ?n)
@@ -686,6 +943,15 @@ class ClusterMember:
         return self.__q_aliases
 
     def _init_qnode(self):
+        mids = [wikidata.freebase_mid(fbid) for fbid in self.freebases if ":NIL" not in fbid]
+        try:
+            _, freebase = wikidata.resolve(mids=mids, aliases=True)
+        except wikidata.Unavailable:
+            freebase = {}
+        self._set_qnodes(freebase)
+
+    def _set_qnodes(self, freebase):
+        # freebase is a {mid: item} dict from wikidata.resolve, possibly shared with the cluster
         self.__qids = {}  # qid to score
         self.__q_urls = {}
         self.__q_labels = {}
@@ -693,41 +959,27 @@ class ClusterMember:
 
         for fbid, score in self.freebases.items():
             if ":NIL" not in fbid:
-                fbid = '/' + fbid[fbid.find(':')+1:].replace('.', '/')
-                query = """
-                    SELECT ?qid ?label WHERE {
-                      ?qid wdt:P646 ?freebase .
-                      ?qid rdfs:label ?label filter (lang(?label) = "en") .
-                    }
-                    LIMIT 1
-                """
-                for q_url, label in wikidata_sparql.query(query, namespaces, {'freebase': Literal(fbid)}):
-                    qid = str(q_url).rsplit('/', 1)[1]
+                item = freebase.get(wikidata.freebase_mid(fbid))
+                if item:
+                    qid = item['qid']
                     self.__qids[qid] = score
-                    self.__q_urls[qid] = str(q_url)
-                    self.__q_labels[qid] = str(label)
-
-                query = """
-                    SELECT ?qid ?alias WHERE {
-                      ?qid wdt:P646 ?freebase .
-                      ?qid skos:altLabel ?alias filter (lang(?alias) = "en") .
-                    }
-                """
-                aliases = []
-                qid = None
-                for q_url, alias in wikidata_sparql.query(query, namespaces, {'freebase': Literal(fbid)}):
-                    qid = str(q_url).rsplit('/', 1)[1]
-                    aliases.append(str(alias))
-                self.__q_aliases[qid] = ', '.join(aliases)
+                    self.__q_urls[qid] = item['url']
+                    self.__q_labels[qid] = item['label']
+                    self.__q_aliases[qid] = ', '.join(item['aliases'])
 
     @property
     def context_extractor(self):
         if self.__context_extractor is None:
-            self.__context_extractor = LTFSourceContext(self.source)
+            self.__context_extractor = LTFSourceContext(self.source, self.model.sources)
         return self.__context_extractor
 
     @property
     def roles(self):
+        if self.__roles is not None:
+            return iter(self.__roles)
+        return self._query_roles()
+
+    def _query_roles(self):
         query = """
         SELECT ?pred ?obj ?objtype (MIN(?objlbl) AS ?objlabel)
         WHERE {
@@ -751,6 +1003,11 @@ class ClusterMember:
 
     @property
     def events_by_role(self):
+        if self.__events_by_role is not None:
+            return iter(self.__events_by_role)
+        return self._query_events_by_role()
+
+    def _query_events_by_role(self):
       query = """
       SELECT ?pred ?event ?event_type (MIN(?lbl) AS ?label)
       WHERE {
@@ -774,6 +1031,11 @@ class ClusterMember:
 
     @property
     def entity_relations(self):
+        if self.__entity_relations is not None:
+            return iter(self.__entity_relations)
+        return self._query_entity_relations()
+
+    def _query_entity_relations(self):
         query = """
         SELECT ?relation ?pred2 ?obj2 ?relation_type (min(?lbl) as ?label)
         WHERE {
@@ -824,6 +1086,10 @@ LIMIT 1 """
             self.__label = label
             self.__type = type_
 
+        self._init_links()
+
+    def _init_links(self, target_rows=None, fbid_rows=None):
+        # rows are given by the batch loader; otherwise they are queried for this member
         self.__targets = {}
         if self.__debug_info:
             if self.__debug_info['targets']:
@@ -832,12 +1098,14 @@ LIMIT 1 """
                     score = self.__debug_info['target_scores'][i]
                     self.__targets[target] = score
         else:
-            query = """
-                SELECT ?target
-                WHERE {
-                  ?member aida:link/aida:linkTarget ?target 
-                } """
-            for target, in self.model.sparql.query(query, namespaces, {'member': self.uri}):
+            if target_rows is None:
+                query = """
+                    SELECT ?target
+                    WHERE {
+                      ?member aida:link/aida:linkTarget ?target 
+                    } """
+                target_rows = [target for target, in self.model.sparql.query(query, namespaces, {'member': self.uri})]
+            for target in target_rows:
                 self.__targets[str(target)] = 0
 
         self.__freebases = {}
@@ -848,16 +1116,17 @@ LIMIT 1 """
                     score = self.__debug_info['fbid_score_avg'][i]
                     self.__freebases[fbid] = score
         else:
-            query = """
-                SELECT DISTINCT ?fbid {
-                   ?member aida:privateData [
-                        aida:jsonContent ?fbid ;
-                        aida:system <http://www.rpi.edu/EDL_Freebase>
-                    ]
-                }
-            """
-
-            for j_fbid, in self.model.sparql.query(query, namespaces, {'member': self.uri}):
+            if fbid_rows is None:
+                query = """
+                    SELECT DISTINCT ?fbid {
+                       ?member aida:privateData [
+                            aida:jsonContent ?fbid ;
+                            aida:system <http://www.rpi.edu/EDL_Freebase>
+                        ]
+                    }
+                """
+                fbid_rows = [j_fbid for j_fbid, in self.model.sparql.query(query, namespaces, {'member': self.uri})]
+            for j_fbid in fbid_rows:
                 fbids = json.loads(j_fbid).get('freebase_link').keys()
                 for fbid in fbids:
                     self.__freebases[fbid] = 0
@@ -875,15 +1144,258 @@ ORDER BY ?start """
         for source, start, end in self.model.sparql.query(query, namespaces, {'member': self.uri}):
             self.__source = str(source)
             self.__context_pos.append((int(start), int(end)))
+        self.__source_loaded = True
 
     @property
     def source(self):
-        if not self.__source:
+        if not self.__source and not self.__source_loaded:
             self._init_source()
         return self.__source
 
+    @classmethod
+    def prefetch(cls, model, members, fields):
+        """
+        Load `fields` of many members with VALUES-batched queries and store them
+        on the members, so their per-member queries are skipped. Fields are
+        'labels', 'member' (missing label/type), 'links' (targets and freebases),
+        'source', 'roles', 'events' and 'relations'. Returns the number of queries.
+        """
+        # a member listed under several types has several objects, all of them are filled
+        everyone = [(m.uri, m) for m in members]
+        members = defaultdict(list)
+        for uri, m in everyone:
+            members[uri].append(m)
+        queries = 0
+        if not members:
+            return 0
+
+        def rows(query, uris, var='member', clauses=()):
+            # the VALUES and the graph clauses are filled in together, in one formatting pass
+            nonlocal queries
+            for batch in batching.batches(uris):
+                queries += 1
+                yield from model.sparql.query(query % ((batching.values(var, batch),) + clauses), namespaces)
+
+        if 'labels' in fields:
+            pref_labels, names = defaultdict(list), defaultdict(list)
+            query = """
+                SELECT ?member ?label (COUNT(?label) AS ?n)
+                WHERE {
+                  %s
+                  ?member aida:justifiedBy/skos:prefLabel ?label .
+                }
+                GROUP BY ?member ?label """
+            for member, label, n in rows(query, members):
+                pref_labels[member].append((label, int(n)))
+            query = """
+                SELECT ?member ?label (COUNT(?label) AS ?n)
+                WHERE {
+                  %s
+                  ?member aida:hasName ?label .
+                }
+                GROUP BY ?member ?label """
+            for member, label, n in rows(query, members):
+                names[member].append((label, int(n)))
+            for uri, m in everyone:
+                all_labels = Counter()
+                for label, n in sorted(pref_labels[uri], key=lambda x: -x[1]):
+                    if label:
+                        all_labels[" ".join(label.split())] = n  # remove double spaces
+                for label, n in sorted(names[uri], key=lambda x: -x[1]):
+                    if label:
+                        all_labels[" ".join(label.split())] += n
+                m.__all_labels = all_labels
+
+        if 'member' in fields:
+            missing = {uri for uri, m in everyone if not m.__label or not m.__type}
+            query = """
+                SELECT ?member (SAMPLE(?lbl) AS ?label) (SAMPLE(?typ) AS ?type)
+                WHERE {
+                  %s
+                  OPTIONAL { ?member aida:hasName ?lbl }
+                  OPTIONAL { ?member aida:justifiedBy ?justification .
+                    ?justification skos:prefLabel ?lbl }
+                  ?statement rdf:subject ?member ;
+                             rdf:predicate rdf:type ;
+                             rdf:object ?typ .
+                }
+                GROUP BY ?member """
+            for member, label, type_ in rows(query, missing):
+                if not label:
+                    _, label = split_uri(type_)
+                for m in members[member]:
+                    m.__label = m.__label or label
+                    m.__type = m.__type or type_
+
+        if 'links' in fields:
+            need = {uri for uri, m in everyone if m.__targets is None and not m.__debug_info}
+            targets, fbids = defaultdict(list), defaultdict(list)
+            query = """
+                SELECT ?member ?target
+                WHERE {
+                  %s
+                  ?member aida:link/aida:linkTarget ?target
+                } """
+            for member, target in rows(query, need):
+                targets[member].append(target)
+            query = """
+                SELECT DISTINCT ?member ?fbid {
+                   %s
+                   ?member aida:privateData [
+                        aida:jsonContent ?fbid ;
+                        aida:system <http://www.rpi.edu/EDL_Freebase>
+                    ]
+                } """
+            for member, j_fbid in rows(query, need):
+                fbids[member].append(j_fbid)
+            for uri, m in everyone:
+                if m.__targets is None:
+                    m._init_links(targets[uri], fbids[uri])
+
+        if 'source' in fields:
+            sources = defaultdict(list)
+            query = """
+                SELECT DISTINCT ?member ?source ?start ?end
+                WHERE {
+                  %s
+                  ?member aida:justifiedBy ?justification .
+                  ?justification aida:source ?source ;
+                                 aida:startOffset ?start ;
+                                 aida:endOffsetInclusive ?end .
+                } """
+            for member, source, start, end in rows(query, members):
+                sources[member].append((int(start), int(end), str(source)))
+            for uri, m in everyone:
+                if m.__source_loaded:
+                    continue
+                for start, end, source in sorted(sources[uri], key=lambda x: x[0]):
+                    m.__source = source
+                    m.__context_pos.append((start, end))
+                m.__source_loaded = True
+
+        related = []  # members created for roles and events, whose clusters are shown too
+        if 'roles' in fields:
+            roles = defaultdict(list)
+            query = """
+                SELECT ?event ?pred ?obj ?objtype (MIN(?objlbl) AS ?objlabel)
+                WHERE {
+                    %s
+                    ?statement rdf:subject ?event ;
+                               rdf:predicate ?pred ;
+                               rdf:object ?obj .
+                    ?objstate rdf:subject ?obj ;
+                              rdf:predicate rdf:type ;
+                              rdf:object ?objtype .
+                    OPTIONAL { ?obj aida:hasName ?objlbl }
+                }
+                GROUP BY ?event ?pred ?obj ?objtype """
+            for event, pred, obj, obj_type, obj_lbl in rows(query, members, 'event'):
+                if not obj_lbl:
+                    _, obj_lbl = split_uri(obj_type)
+                ind = pred.find('_')
+                obj = ClusterMember(model, obj, obj_lbl, obj_type)
+                roles[event].append((pred[ind+1:], obj))
+                related.append(obj)
+            for uri, m in everyone:
+                m.__roles = roles[uri]
+
+        if 'events' in fields:
+            events = defaultdict(list)
+            query = """
+                SELECT ?obj ?pred ?event ?event_type (MIN(?lbl) AS ?label)
+                WHERE {
+                    %s
+                    ?event a aida:Event .
+                    ?statement rdf:subject ?event ;
+                              rdf:predicate ?pred ;
+                              rdf:object ?obj .
+                    ?event_state rdf:subject ?event ;
+                              rdf:predicate rdf:type ;
+                              rdf:object ?event_type .
+                    OPTIONAL { ?event aida:justifiedBy/skos:prefLabel ?lbl }
+                }
+                GROUP BY ?obj ?pred ?event ?event_type """
+            for obj, pred, event, event_type, event_lbl in rows(query, members, 'obj'):
+                if not event_lbl:
+                    _, event_lbl = split_uri(event_type)
+                ind = pred.find('_')
+                event = ClusterMember(model, event, event_lbl, event_type)
+                events[obj].append((pred[ind+1:], event))
+                related.append(event)
+            for uri, m in everyone:
+                m.__events_by_role = events[uri]
+
+        if 'relations' in fields:
+            relations = defaultdict(list)
+            query = """
+                SELECT ?obj ?relation ?pred2 ?obj2 ?relation_type (MIN(?lbl) AS ?label)
+                WHERE {
+                    %s
+                    ?relation a aida:Relation .
+                    ?s1 rdf:subject ?relation ;
+                                rdf:predicate ?pred ;
+                                rdf:object ?obj .
+                    ?s2 rdf:subject ?relation ;
+                                rdf:predicate rdf:type ;
+                                rdf:object ?relation_type .
+                    ?s3 rdf:subject ?relation ;
+                                rdf:predicate ?pred2 ;
+                                rdf:object ?obj2 .
+                    OPTIONAL {?obj2 aida:hasName ?lbl}
+                    FILTER(?s3 != ?s2 && ?s3 != ?s1)
+                }
+                GROUP BY ?obj ?relation ?pred2 ?obj2 ?relation_type """
+            for obj, relation, pred, obj2, relation_type, label in rows(query, members, 'obj'):
+                _, relation_type = split_uri(relation_type)
+                relations[obj].append((relation_type, obj2, label))
+            for uri, m in everyone:
+                m.__entity_relations = relations[uri]
+
+        if related:
+            # the clusters of role objects and events, one shared Cluster per uri
+            first = everyone[0][1]
+            open_clause, close_clause = first.__open_clause, first.__close_clause
+            by_uri = defaultdict(list)
+            for m in related:
+                by_uri[m.uri].append(m)
+            clusters = {}
+            query = """
+                SELECT ?member ?cluster
+                WHERE {
+                  %s
+                  %s
+                  ?membership aida:cluster ?cluster ;
+                              aida:clusterMember ?member .
+                  MINUS {?cluster aida:prototype ?member}
+                  %s
+                } """
+            for member, cluster in rows(query, by_uri, clauses=(open_clause, close_clause)):
+                if cluster not in clusters:
+                    clusters[cluster] = Cluster(model, cluster)  # known to exist, no ASK needed
+                for m in by_uri[member]:
+                    m.__cluster = clusters[cluster]
+
+        return queries
+
+    @classmethod
+    def prefetch_mentions(cls, members):
+        """
+        Extract the mentions of members whose sources are loaded, one pass per document.
+        """
+        members = [m for m in members if m.__source_loaded and m.__source]
+        if not members:
+            return
+        spans = [(m.__source, start, end) for m in members for start, end in m.__context_pos]
+        contexts = extract_mentions(spans, members[0].model.sources)
+        for m in members:
+            doc_contexts = contexts.get(m.__source, {})
+            m.__mentions = [doc_contexts[pos] for pos in m.__context_pos if doc_contexts.get(pos)]
+
     @property
     def mention(self):
+        if self.__mentions is not None:
+            yield from self.__mentions
+            return
         if self.context_extractor.doc_exists():
             for start, end in self.__context_pos:
                 res = self.context_extractor.query_context(start, end)
@@ -0,0 +1,165 @@
+"""
+Graphviz renders of neighborhood graphs, run off the request threads.
+
+Each render is one graphviz process driven by a worker of a bounded pool, so
+at most setting.render_workers layouts run at a time. A graph that is already
+queued or rendering is not rendered again, its job is shared. Jobs are only
+shared within a process: web workers sharing img_dir may render the same
+graph concurrently, each into a file of its own that is renamed over the
+image, and the pages of other workers wait for the image file itself. A
+layout that does not finish within setting.render_timeout seconds is retried
+with the cheaper setting.render_fallback_engine.
+"""
+from concurrent.futures import ThreadPoolExecutor
+import os
+import subprocess
+import tempfile
+import threading
+import time
+import setting
+
+img_dir = 'static/img/'
+layout_args = ['-Goverlap=prism', '-Goverlap_scaling=5', '-Gsep=+20']
+PENDING = 'pending'
+FAILED = 'failed'
+
+
+def _temp_path(path):
+    fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(path) + '.', suffix='.part',
+                                     dir=os.path.dirname(path) or '.')
+    os.close(fd)
+    return temp_path
+
+
+def write_atomic(path, text):
+    temp_path = _temp_path(path)
+    try:
+        with open(temp_path, 'w') as f:
+            f.write(text)
+        os.replace(temp_path, path)
+    finally:
+        if os.path.isfile(temp_path):
+            os.remove(temp_path)
+
+
+class Renderer:
+    def __init__(self, workers, timeout, engine='sfdp', fallback_engine='neato'):
+        self.timeout = timeout
+        self.engine = engine
+        self.fallback_engine = fallback_engine
+        self.workers = workers
+        self.__pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='render')
+        self.__lock = threading.Lock()
+        self.__jobs = {}  # image path to the future of its render, while queued or running
+        self.__failed = {}  # image path to the error of its last render
+        self.__queued = 0
+        self.__running = 0
+        self.__counters = {'renders': 0, 'shared': 0, 'timeouts': 0, 'fallbacks': 0, 'failures': 0}
+        self.__seconds = {'total': 0.0, 'max': 0.0, 'last': 0.0}
+
+    def submit(self, img_path, dot, format='svg'):
+        """
+        Queue the render of the DOT text to img_path, or join the render already
+        queued for it. Returns a future of whether the image was written.
+        """
+        with self.__lock:
+            job = self.__jobs.get(img_path)
+            if job is not None:
+                self.__counters['shared'] += 1
+                return job
+            self.__failed.pop(img_path, None)
+            self.__queued += 1
+            job = self.__jobs[img_path] = self.__pool.submit(self.__render, img_path, dot, format)
+            return job
+
+    def status(self, img_path):
+        """
+        PENDING while the image is queued or rendering, FAILED if its last render
+        failed, otherwise None.
+        """
+        with self.__lock:
+            if img_path in self.__jobs:
+                return PENDING
+            if img_path in self.__failed:
+                return FAILED
+            return None
+
+    def error(self, img_path):
+        return self.__failed.get(img_path)
+
+    def __layout(self, engine, dot_path, img_path, format):
+        # graphviz writes next to the image, which is replaced once complete; the
+        # file is unique, as other processes may render the same image
+        part_path = _temp_path(img_path)
+        try:
+            subprocess.run(['dot', '-T' + format, '-o', part_path, dot_path, '-K' + engine] + layout_args,
+                           timeout=self.timeout, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+            os.replace(part_path, img_path)
+        finally:
+            if os.path.isfile(part_path):
+                os.remove(part_path)
+
+    def __render(self, img_path, dot, format):
+        with self.__lock:
+            self.__queued -= 1
+            self.__running += 1
+        started = time.time()
+        error = None
+        try:
+            dot_path = os.path.splitext(img_path)[0] + '.dot'
+            write_atomic(dot_path, dot)
+            try:
+                self.__layout(self.engine, dot_path, img_path, format)
+            except subprocess.TimeoutExpired:
+                print('Render of %s timed out with %s, retrying with %s' % (img_path, self.engine, self.fallback_engine))
+                self.__count('timeouts')
+                self.__count('fallbacks')
+                self.__layout(self.fallback_engine, dot_path, img_path, format)
+        except subprocess.TimeoutExpired:
+            self.__count('timeouts')
+            error = 'timed out'
+        except subprocess.CalledProcessError as e:
+            error = (e.stderr or b'').decode('utf-8', 'replace').strip() or 'graphviz exited with %d' % e.returncode
+        except OSError as e:
+            error = repr(e)
+        finally:
+            seconds = time.time() - started
+            with self.__lock:
+                self.__running -= 1
+                del self.__jobs[img_path]
+                self.__counters['renders'] += 1
+                self.__seconds['total'] += seconds
+                self.__seconds['max'] = max(self.__seconds['max'], seconds)
+                self.__seconds['last'] = seconds
+                if error is not None:
+                    self.__counters['failures'] += 1
+                    self.__failed[img_path] = error
+        if error is not None:
+            print('Failed to render', img_path, error)
+            return False
+        print('Rendered %s in %.1fs' % (img_path, seconds))
+        return True
+
+    def __count(self, name):
+        with self.__lock:
+            self.__counters[name] += 1
+
+    def stats(self):
+        with self.__lock:
+            seconds = dict(self.__seconds)
+            if self.__counters['renders']:
+                seconds['mean'] = seconds['total'] / self.__counters['renders']
+            return dict(self.__counters, workers=self.workers, queued=self.__queued, running=self.__running,
+                        seconds={k: round(v, 3) for k, v in seconds.items()})
+
+
+renderer = Renderer(setting.render_workers, setting.render_timeout,
+                    setting.render_engine, setting.render_fallback_engine)
+
+
+def image_path(name, format='svg'):
+    return img_dir + name + '.' + format
+
+
+def stats():
+    return renderer.stats()
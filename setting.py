@@ -2,8 +2,42 @@ port = '5000'
 endpoint = 'http://gaiadev01.isi.edu:7200/repositories'
 # wikidata_endpoint = "http://sitaware.isi.edu:8080/bigdata/namespace/wdq/sparql"
 wikidata_endpoint = 'https://query.wikidata.org/sparql'
+# local GeoNames/Freebase to Wikidata index built with wikidata.py; the endpoint is used when it is missing
+wikidata_crosswalk = 'store_data/wikidata-crosswalk.pak'
+# live wikidata queries: worker threads and seconds to wait for each query
+wikidata_workers = 4
+wikidata_timeout = 10
+# resolved ids kept per process, and seconds to keep ids that resolved and ids that did not
+wikidata_memo_size = 200000
+wikidata_memo_ttl = 7 * 24 * 60 * 60
+wikidata_memo_negative_ttl = 24 * 60 * 60
 store_data = 'store_data'
 debug_data = 'debug'
+# debug records kept in memory after they were read from a debug file
+debug_cache_size = 1000
+# parsed LTF source documents kept in memory for mention contexts
+ltf_cache_size = 500
+text_cache_size = 200
+# threads extracting the mentions of a cluster page, one document per task; 0 extracts inline
+mention_workers = 4
+# packed source documents built with source_store.py; when it exists, documents not in it are missing,
+# otherwise the loose files are read
+source_store = 'store_data/sources.pak'
+# graphviz renders of neighborhood graphs: concurrent renders, and seconds before a layout
+# is retried with the fallback engine
+render_workers = 2
+render_timeout = 30
+render_engine = 'sfdp'
+render_fallback_engine = 'neato'
+# clusters expanded and super edges drawn at most for a neighborhood graph
+neighborhood_max_nodes = 500
+neighborhood_max_edges = 2000
+# rendered images kept, by total size of the images and their DOT files
+image_cache_bytes = 512 * 1024 * 1024
+# SPARQL result cache: entries kept in memory, and an optional sqlite file that survives restarts
+query_cache_size = 20000
+query_cache_path = None
+query_cache_disk_rows = 200000
 repositories = ['eval-cmu-ta2']
 username = 'admin'
 password = 'gaia@isi'
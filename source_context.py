@@ -1,11 +1,32 @@
+from array import array
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+import mmap
+import os
 import xml.etree.ElementTree as ET
+import cache
+import setting
+import source_store
+
+# parsed LTF documents, shared by all requests
+ltf_documents = cache.LRUCache(setting.ltf_cache_size)
+# memory-mapped text documents
+text_documents = cache.LRUCache(setting.text_cache_size)
+# the default `sources` of a context: the store is looked up when the context is made
+LOOKUP = object()
 
 
 class SourceContext:
-    def __init__(self, doc_id):
+    def __init__(self, doc_id, sources=LOOKUP):
+        """
+        `sources` is the packed source store, or None if there is none; callers
+        making many contexts resolve it once with source_store.source_store().
+        """
         self.doc_id = doc_id
         self.filepath = None
+        self.sources = source_store.source_store() if sources is LOOKUP else sources
+        self.packed = None  # the document in the packed source store, if it is there
 
     @staticmethod
     def get_some_context(src, start, end):
@@ -18,7 +39,10 @@ class SourceContext:
         return ''
 
     def doc_exists(self):
-        return self.filepath and self.filepath.is_file()
+        # once there is a store, it is the corpus: its documents are not looked for on disk
+        if self.sources is not None:
+            return self.packed is not None
+        return bool(self.filepath and self.filepath.is_file())
 
     def query_context(self, start, end):
         raise NotImplementedError
@@ -27,36 +51,138 @@ class SourceContext:
 class LTFSourceContext(SourceContext):
     source_path = Path('/lfs1/gaia/m9copora/ltf')
 
-    def __init__(self, doc_id):
-        super().__init__(doc_id)
+    def __init__(self, doc_id, sources=LOOKUP):
+        super().__init__(doc_id, sources)
         self.filepath = self.source_path / (doc_id + '.ltf.xml')
+        if self.sources is not None:
+            self.packed = self.sources.ltf(doc_id)
+
+    def document(self):
+        if self.packed is not None:
+            return self.packed
+        st = os.stat(self.filepath)
+        key = (str(self.filepath), st.st_mtime_ns)
+        document = ltf_documents.get(key)
+        if document is None:
+            document = LTFDocument(self.filepath)
+            ltf_documents.put(key, document)
+        return document
 
     def query_context(self, start, end):
-        tree = ET.parse(self.filepath)
-        root = tree.getroot()
+        return self.document().context(start, end)
+
+
+class LTFDocument:
+    """
+    Segment offsets and texts of an LTF document, parsed once and incrementally.
+    """
+    def __init__(self, filepath):
+        self.starts = array('q')
+        self.ends = array('q')
+        self.texts = []
+        for _, elem in ET.iterparse(str(filepath)):
+            if elem.tag == 'SEG':
+                self.starts.append(int(elem.get('start_char')))
+                self.ends.append(int(elem.get('end_char')))
+                self.texts.append(elem.findtext('ORIGINAL_TEXT') or '')
+                elem.clear()
+        self.sorted = all(self.starts[i] <= self.starts[i + 1] and self.ends[i] <= self.ends[i + 1]
+                          for i in range(len(self.starts) - 1))
+
+    def context(self, start, end):
+        """
+        Texts of the segments overlapping start-end, joined by spaces.
+        """
+        if self.sorted:
+            first = bisect_left(self.ends, start)
+            last = bisect_right(self.starts, end)
+            return ' '.join(self.texts[first:last])
         texts = []
-        for child in root.findall('./DOC/TEXT/SEG'):
-            seg_start, seg_end = int(child.get('start_char')), int(child.get('end_char'))
+        for seg_start, seg_end, text in zip(self.starts, self.ends, self.texts):
             if seg_end < start:
                 continue
             if seg_start > end:
                 break
-            text = child.find('ORIGINAL_TEXT').text
             texts.append(text)
         return ' '.join(texts)
 
 
+# documents of a cluster page are read on these threads, unless mention_workers is 0
+mention_pool = ThreadPoolExecutor(max_workers=setting.mention_workers, thread_name_prefix='mentions') \
+    if setting.mention_workers else None
+
+
+def _document_contexts(doc_id, spans, sources):
+    context_extractor = LTFSourceContext(doc_id, sources)
+    if not context_extractor.doc_exists():
+        return None
+    document = context_extractor.document()
+    return {(start, end): document.context(start, end) for start, end in spans}
+
+
+def extract_mentions(spans, sources=LOOKUP):
+    """
+    LTF contexts of many (doc_id, start, end) spans, opening every document once;
+    documents are processed on a pool of setting.mention_workers threads if set.
+    Returns {doc_id: {(start, end): context}} for the documents that exist.
+    """
+    if sources is LOOKUP:
+        sources = source_store.source_store()
+    by_doc = {}
+    for doc_id, start, end in spans:
+        by_doc.setdefault(doc_id, set()).add((start, end))
+
+    if mention_pool is not None and len(by_doc) > 1:
+        futures = {doc_id: mention_pool.submit(_document_contexts, doc_id, doc_spans, sources)
+                   for doc_id, doc_spans in by_doc.items()}
+        contexts = {doc_id: future.result() for doc_id, future in futures.items()}
+    else:
+        contexts = {doc_id: _document_contexts(doc_id, doc_spans, sources) for doc_id, doc_spans in by_doc.items()}
+    return {doc_id: doc_contexts for doc_id, doc_contexts in contexts.items() if doc_contexts is not None}
+
+
 class TextSourceContext(SourceContext):
     source_path = Path('rsd')
 
-    def __init__(self, doc_id):
-        super().__init__(doc_id)
+    def __init__(self, doc_id, sources=LOOKUP):
+        super().__init__(doc_id, sources)
         self.filepath = self.source_path / (doc_id + '.rsd.txt')
+        if self.sources is not None:
+            self.packed = self.sources.text(doc_id)
+
+    def document(self):
+        """
+        The document to take snippets from, or None if the file has to be read as a whole.
+        """
+        if self.packed is not None:
+            return self.packed
+        st = os.stat(self.filepath)
+        key = (str(self.filepath), st.st_mtime_ns)
+        document = text_documents.get(key)
+        if document is None:
+            document = TextDocument(self.filepath)
+            text_documents.put(key, document)
+        return document if document.mm is not None else None
 
     def query_context(self, start, end, length=160):
         """
         Get context, front<--------><em>start-end</em><------->back
         """
+        document = self.document()
+        if document is None:
+            return self.read_context(start, end, length)
+        end = end+1
+        total = document.length
+        front, back = self.calculate_double_side_length(start, end, length, total)
+        data = document.text(front, max(back, end))
+        snippet = data[:start-front] + '<em>' + data[start-front:end-front] + '</em>' + data[end-front:back-front]
+        if front != 0: snippet = '......' + snippet
+        if back != total: snippet += '......'
+        snippet = snippet.replace('\n', ' ')
+        return snippet
+
+    def read_context(self, start, end, length=160):
+        # whole-file read, for files whose offsets count translated newlines
         end = end+1
         with open(self.filepath) as f:
             data = f.read()
@@ -85,6 +211,66 @@ class TextSourceContext(SourceContext):
         return start - forward, end + backward
 
 
+class TextDocument:
+    """
+    A memory-mapped UTF-8 text file with the byte offset of every block_chars-th
+    character, so a character range is read without decoding the whole file.
+    Files containing carriage returns are not mapped (mm is None): text mode
+    reads translate them, which shifts character offsets.
+    """
+    block_chars = 64 * 1024
+
+    def __init__(self, filepath):
+        self.mm = None
+        self.length = 0
+        self.char_starts = array('q', [0])
+        self.byte_starts = array('q', [0])
+        with open(filepath, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if mm.find(b'\r') >= 0:
+            mm.close()
+            return
+        chars = 0
+        next_checkpoint = self.block_chars
+        step = 1024 * 1024
+        offset = 0
+        while offset < len(mm):
+            stop = min(offset + step, len(mm))
+            while stop < len(mm) and 0x80 <= mm[stop] < 0xC0:
+                stop -= 1  # end blocks on a character boundary
+            try:
+                text = mm[offset:stop].decode('utf-8')
+            except UnicodeDecodeError:
+                mm.close()
+                return
+            position, byte = 0, offset
+            while chars + len(text) >= next_checkpoint:
+                # byte offset of character next_checkpoint, within this block
+                byte += len(text[position:next_checkpoint - chars].encode('utf-8'))
+                position = next_checkpoint - chars
+                self.char_starts.append(next_checkpoint)
+                self.byte_starts.append(byte)
+                next_checkpoint += self.block_chars
+            chars += len(text)
+            offset = stop
+        self.length = chars
+        self.mm = mm
+
+    def byte_offset(self, char):
+        char = min(max(char, 0), self.length)
+        i = bisect_right(self.char_starts, char) - 1
+        start = self.byte_starts[i]
+        n = char - self.char_starts[i]
+        # n characters take at most 4n bytes; a character cut at the end of the window is dropped
+        window = self.mm[start:start + 4 * n].decode('utf-8', 'ignore')
+        return start + len(window[:n].encode('utf-8'))
+
+    def text(self, start, end):
+        return self.mm[self.byte_offset(start):self.byte_offset(end)].decode('utf-8')
+
+
 if __name__ == '__main__':
     sc = TextSourceContext('HC000ZXSM')
     print(sc.doc_exists())
@@ -0,0 +1,206 @@
+"""
+A corpus of source documents packed into one file, so mention contexts are
+read without probing the filesystem for every document:
+
+    python source_store.py <store file> --ltf <ltf dir> --rsd <rsd dir>
+
+LTF documents are stored as pre-extracted segments (offsets and texts), text
+documents as their decoded text with character checkpoints; snippets are
+read from the text section with a single positioned read.
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+from pathlib import Path
+import argparse
+import os
+import tempfile
+import time
+import setting
+import store
+
+version = 1
+block_chars = 64 * 1024  # characters between two checkpoints of a text document
+LTF = 'ltf'
+RSD = 'rsd'
+
+
+class PackedLTFDocument:
+    def __init__(self, packed, first, count, sorted_):
+        self.__packed = packed
+        self.__first = first
+        self.starts = packed.seg_starts[first:first + count]
+        self.ends = packed.seg_ends[first:first + count]
+        self.sorted = sorted_
+
+    def __texts(self, first, last):
+        if first >= last:
+            return []
+        offsets = self.__packed.seg_offsets
+        base = offsets[self.__first + first]
+        data = self.__packed.read(base, offsets[self.__first + last] - base)
+        return [data[offsets[self.__first + i] - base:offsets[self.__first + i + 1] - base].decode('utf-8')
+                for i in range(first, last)]
+
+    def context(self, start, end):
+        if self.sorted:
+            first = bisect_left(self.ends, start)
+            last = bisect_right(self.starts, end)
+            return ' '.join(self.__texts(first, last))
+        texts = self.__texts(0, len(self.starts))
+        selected = []
+        for seg_start, seg_end, text in zip(self.starts, self.ends, texts):
+            if seg_end < start:
+                continue
+            if seg_start > end:
+                break
+            selected.append(text)
+        return ' '.join(selected)
+
+
+class PackedTextDocument:
+    def __init__(self, packed, offset, size, length, first, count):
+        self.__packed = packed
+        self.__offset = offset
+        self.__size = size
+        self.length = length
+        self.__char_starts = packed.checkpoint_chars[first:first + count]
+        self.__byte_starts = packed.checkpoint_bytes[first:first + count]
+
+    def text(self, start, end):
+        start, end = min(max(start, 0), self.length), min(max(end, start), self.length)
+        i = bisect_right(self.__char_starts, start) - 1
+        base = self.__byte_starts[i]
+        # at most 4 bytes per character from the checkpoint before start
+        size = min(4 * (end - self.__char_starts[i]), self.__size - base)
+        data = self.__packed.read(self.__offset + base, size).decode('utf-8', 'ignore')
+        skip = start - self.__char_starts[i]
+        return data[skip:skip + end - start]
+
+
+class SourceStore:
+    def __init__(self, path):
+        self.__packed = packed = store.Packed(path)
+        if packed.meta.get('version') != version:
+            raise ValueError('Unsupported source store version in ' + path)
+        self.__keys = packed.strings('keys')
+        self.__docs = packed.array('docs')  # per document: offset, size, length, first, count, sorted
+        self.seg_starts = packed.array('seg_starts')
+        self.seg_ends = packed.array('seg_ends')
+        self.seg_offsets = packed.array('seg_offsets')
+        self.checkpoint_chars = packed.array('checkpoint_chars')
+        self.checkpoint_bytes = packed.array('checkpoint_bytes')
+        self.__text_offset, _ = packed.section_span('text')
+        self.__fd = os.open(path, os.O_RDONLY)
+
+    def __len__(self):
+        return len(self.__keys)
+
+    def read(self, offset, size):
+        return os.pread(self.__fd, size, self.__text_offset + offset)
+
+    def __row(self, kind, doc_id):
+        i = self.__keys.find(kind + ':' + doc_id)
+        if i < 0:
+            return None
+        return self.__docs[6 * i:6 * i + 6]
+
+    def has(self, kind, doc_id):
+        return self.__keys.find(kind + ':' + doc_id) >= 0
+
+    def ltf(self, doc_id):
+        row = self.__row(LTF, doc_id)
+        if row is None:
+            return None
+        _, _, _, first, count, sorted_ = row
+        return PackedLTFDocument(self, first, count, bool(sorted_))
+
+    def text(self, doc_id):
+        row = self.__row(RSD, doc_id)
+        if row is None:
+            return None
+        offset, size, length, first, count, _ = row
+        return PackedTextDocument(self, offset, size, length, first, count)
+
+
+_source_store = None
+
+
+def source_store():
+    global _source_store
+    path = setting.source_store
+    if _source_store is None and path and os.path.isfile(path):
+        _source_store = SourceStore(path)
+    return _source_store
+
+
+def _checkpoints(text):
+    """
+    (character, byte) offsets of every block_chars-th character of text, from (0, 0).
+    """
+    chars, bytes_ = array('q', [0]), array('q', [0])
+    byte = 0
+    for i in range(block_chars, len(text) + 1, block_chars):
+        byte += len(text[i - block_chars:i].encode('utf-8'))
+        chars.append(i)
+        bytes_.append(byte)
+    return chars, bytes_
+
+
+def build(path, ltf_dir=None, rsd_dir=None):
+    from source_context import LTFDocument
+
+    started = time.time()
+    rows = {}  # key to (offset, size, length, first, count, sorted)
+    seg_starts, seg_ends, seg_offsets = array('q'), array('q'), array('Q', [0])
+    checkpoint_chars, checkpoint_bytes = array('q'), array('q')
+    directory = os.path.dirname(os.path.abspath(path))
+    with tempfile.TemporaryFile(dir=directory) as blob:
+        offset = 0
+        if ltf_dir:
+            for file in sorted(Path(ltf_dir).glob('*.ltf.xml')):
+                document = LTFDocument(file)
+                first = len(seg_starts)
+                for seg_start, seg_end, text in zip(document.starts, document.ends, document.texts):
+                    data = text.encode('utf-8')
+                    blob.write(data)
+                    offset += len(data)
+                    seg_starts.append(seg_start)
+                    seg_ends.append(seg_end)
+                    seg_offsets.append(offset)
+                rows[LTF + ':' + file.name[:-len('.ltf.xml')]] = (
+                    seg_offsets[first], offset - seg_offsets[first], 0, first, len(seg_starts) - first, int(document.sorted))
+        if rsd_dir:
+            for file in sorted(Path(rsd_dir).glob('*.rsd.txt')):
+                # the text as a text-mode read returns it, which is what the offsets count
+                with open(file) as f:
+                    text = f.read()
+                data = text.encode('utf-8')
+                blob.write(data)
+                chars, bytes_ = _checkpoints(text)
+                first = len(checkpoint_chars)
+                checkpoint_chars.extend(chars)
+                checkpoint_bytes.extend(bytes_)
+                rows[RSD + ':' + file.name[:-len('.rsd.txt')]] = (offset, len(data), len(text), first, len(chars), 0)
+                offset += len(data)
+
+        keys = sorted(rows, key=lambda k: k.encode('utf-8'))
+        docs = array('Q')
+        for key in keys:
+            docs.extend(rows[key])
+        sections = {'docs': docs, 'seg_starts': seg_starts, 'seg_ends': seg_ends, 'seg_offsets': seg_offsets,
+                    'checkpoint_chars': checkpoint_chars, 'checkpoint_bytes': checkpoint_bytes}
+        store.write_strings(sections, 'keys', keys)
+        blob.seek(0)
+        sections['text'] = blob
+        store.write(path, {'version': version, 'documents': len(keys)}, sections)
+    print('Packed %d documents into %s in %.1fs' % (len(rows), path, time.time() - started))
+    return len(rows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack source documents for mention contexts.')
+    parser.add_argument('path', help='store file to write')
+    parser.add_argument('--ltf', help='directory of .ltf.xml documents')
+    parser.add_argument('--rsd', help='directory of .rsd.txt documents')
+    args = parser.parse_args()
+    build(args.path, args.ltf, args.rsd)
@@ -0,0 +1,153 @@
+"""
+Read-only packed files: a small JSON header followed by 8-byte aligned
+sections (typed arrays and string columns) that are memory-mapped, so every
+worker process reading the same file shares its pages.
+"""
+from array import array
+import json
+import mmap
+import os
+import shutil
+import struct
+import sys
+
+MAGIC = b'GAIAPAK1'
+_HEAD = struct.Struct('<8sQ')
+
+
+def _pad(n):
+    return (8 - n % 8) % 8
+
+
+def pack_strings(strings):
+    """
+    Encode strings as an offsets array (n+1 entries) and one utf-8 blob.
+    """
+    offsets = array('Q', [0])
+    blob = bytearray()
+    for s in strings:
+        blob += s.encode('utf-8') if isinstance(s, str) else s
+        offsets.append(len(blob))
+    return offsets, bytes(blob)
+
+
+def write(path, meta, sections):
+    """
+    Write sections (name to array.array, bytes or a binary file) to path atomically.
+    String columns are written as two sections: <name>.offsets and <name>.blob.
+    """
+    layout = {}
+    chunks = []
+    offset = 0
+    for name, data in sections.items():
+        if isinstance(data, array):
+            typecode, raw = data.typecode, data.tobytes()
+            length = len(raw)
+        elif hasattr(data, 'read'):  # a file positioned at its start, copied in chunks
+            typecode, raw = 'B', data
+            length = os.fstat(data.fileno()).st_size
+        else:
+            typecode, raw = 'B', bytes(data)
+            length = len(raw)
+        layout[name] = [offset, length, typecode]
+        chunks.append(raw)
+        chunks.append(b'\0' * _pad(length))
+        offset += length + _pad(length)
+
+    header = json.dumps({'meta': meta, 'byteorder': sys.byteorder, 'sections': layout}).encode('utf-8')
+    header += b' ' * _pad(_HEAD.size + len(header))
+
+    tmp_path = '%s.tmp-%d' % (path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        f.write(_HEAD.pack(MAGIC, len(header)))
+        f.write(header)
+        for chunk in chunks:
+            if hasattr(chunk, 'read'):
+                shutil.copyfileobj(chunk, f, 1024 * 1024)
+            else:
+                f.write(chunk)
+    os.replace(tmp_path, path)
+
+
+def write_strings(sections, name, strings):
+    sections[name + '.offsets'], sections[name + '.blob'] = pack_strings(strings)
+
+
+class Packed:
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self.__mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, header_len = _HEAD.unpack_from(self.__mm, 0)
+        if magic != MAGIC:
+            raise ValueError('Not a packed file: ' + path)
+        header = json.loads(self.__mm[_HEAD.size:_HEAD.size + header_len].decode('utf-8'))
+        if header['byteorder'] != sys.byteorder:
+            raise ValueError('Packed file was written with a different byte order: ' + path)
+        self.meta = header['meta']
+        self.__base = _HEAD.size + header_len
+        self.__sections = header['sections']
+        self.__view = memoryview(self.__mm)
+
+    def __contains__(self, name):
+        return name in self.__sections or name + '.offsets' in self.__sections
+
+    def bytes(self, name):
+        offset, length, _ = self.__sections[name]
+        start = self.__base + offset
+        return self.__view[start:start + length]
+
+    def array(self, name):
+        return self.bytes(name).cast(self.__sections[name][2])
+
+    def strings(self, name):
+        return Strings(self.array(name + '.offsets'), self.bytes(name + '.blob'))
+
+    def section_span(self, name):
+        """
+        Absolute (offset, length) of a section in the file, for positioned reads.
+        """
+        offset, length, _ = self.__sections[name]
+        return self.__base + offset, length
+
+
+class Strings:
+    """
+    A string column; find and bisect assume it was written in sorted (utf-8 byte) order.
+    """
+    def __init__(self, offsets, blob):
+        self.__offsets = offsets
+        self.__blob = blob
+
+    def __len__(self):
+        return len(self.__offsets) - 1
+
+    def raw(self, i):
+        return self.__blob[self.__offsets[i]:self.__offsets[i + 1]].tobytes()
+
+    def __getitem__(self, i):
+        return self.raw(i).decode('utf-8')
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def bisect(self, key):
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+        lo, hi = 0, len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.raw(mid) < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def find(self, key):
+        if isinstance(key, str):
+            key = key.encode('utf-8')
+        i = self.bisect(key)
+        if i < len(self) and self.raw(i) == key:
+            return i
+        return -1
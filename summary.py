@@ -0,0 +1,371 @@
+from array import array
+import os
+import pickle
+import re
+import threading
+import store
+
+summary_dir = 'pkl'
+version = 1
+
+HAS_SIZE = 1
+HAS_LABEL = 2
+HAS_TYPE = 4
+HAS_PROTOTYPE = 8
+HAS_NAME = 16
+HAS_COUNT = 32
+HAS_DIGEST = 64
+HAS_CATEGORY = 128
+
+sort_orders = ('size', 'type', 'label')
+
+
+def summary_id(repo, graph):
+    sid = repo
+    if graph:
+        sid = sid + '-' + re.sub('[^0-9a-zA-Z]+', '-', graph)
+    return sid
+
+
+def summary_path(repo, graph):
+    return summary_dir + '/' + summary_id(repo, graph) + '.sum'
+
+
+def legacy_path(repo, graph):
+    return summary_dir + '/' + summary_id(repo, graph) + '.pkl'
+
+
+def load_legacy(path):
+    with open(path, 'rb') as f:
+        return pickle.load(f)
+
+
+def order_section(kind, sortby):
+    return 'order|%s|%s' % (kind, sortby)
+
+
+def _list_orders(uris, data):
+    """
+    Row orders of the cluster lists, per prototype kind: by size (member count
+    without the prototype, descending), by type then size, and by list name.
+    Only clusters that the list query would return (count > 0) are included.
+    """
+    rows = {}
+    for i, uri in enumerate(uris):
+        cluster = data[uri]
+        if cluster.get('kind') is not None and cluster.get('count'):
+            rows.setdefault(str(cluster['kind']), []).append(i)
+
+    def by_size(i):
+        return -data[uris[i]]['count'], uris[i]
+
+    def by_type(i):
+        cluster = data[uris[i]]
+        type_ = str(cluster.get('type') or '')
+        # relation clusters record only their kind as type, so their category name decides
+        category = str(cluster.get('name') or '') if type_ == str(cluster['kind']) else ''
+        return type_, category, -cluster['count'], uris[i]
+
+    def by_label(i):
+        return str(data[uris[i]].get('name') or ''), uris[i]
+
+    orders = {}
+    for kind, members in rows.items():
+        orders[order_section(kind, 'size')] = sorted(members, key=by_size)
+        orders[order_section(kind, 'type')] = sorted(members, key=by_type)
+        orders[order_section(kind, 'label')] = sorted(members, key=by_label)
+    return orders
+
+
+def write_summary(data, path, fingerprint=None):
+    """
+    Write a {cluster uri: {'size', 'label', 'type', 'prototype', 'kind', 'category', 'name', 'count', 'digest'}}
+    dict as a SummaryStore file. Any of the keys may be missing for a cluster.
+    'kind' is the prototype class, 'category' its rdf:type statement ('' if it has none),
+    'name' and 'count' are what the cluster lists show, 'digest' is a hash of the cluster's members.
+    """
+    uris = sorted((str(u) for u in data), key=lambda u: u.encode('utf-8'))
+    data = {str(u): c for u, c in data.items()}
+    type_ids, kind_ids = {}, {}
+    labels, prototypes, names, digests, categories = [], [], [], [], []
+    sizes, counts, types, kinds, flags = array('q'), array('q'), array('i'), array('b'), array('B')
+    for uri in uris:
+        cluster = data[uri]
+        flag = 0
+        size = cluster.get('size')
+        if size is not None:
+            flag |= HAS_SIZE
+        count = cluster.get('count')
+        if count is not None:
+            flag |= HAS_COUNT
+        label = cluster.get('label')
+        if label is not None:
+            flag |= HAS_LABEL
+        type_ = cluster.get('type')
+        if type_ is not None:
+            flag |= HAS_TYPE
+            type_ = type_ids.setdefault(str(type_), len(type_ids))
+        prototype = cluster.get('prototype')
+        if prototype is not None:
+            flag |= HAS_PROTOTYPE
+        name = cluster.get('name')
+        if name is not None:
+            flag |= HAS_NAME
+        digest = cluster.get('digest')
+        if digest is not None:
+            flag |= HAS_DIGEST
+        category = cluster.get('category')
+        if category is not None:
+            flag |= HAS_CATEGORY
+        kind = cluster.get('kind')
+        if kind is not None:
+            kind = kind_ids.setdefault(str(kind), len(kind_ids))
+        labels.append(str(label) if label is not None else '')
+        prototypes.append(str(prototype) if prototype is not None else '')
+        names.append(str(name) if name is not None else '')
+        digests.append(str(digest) if digest is not None else '')
+        categories.append(str(category) if category is not None else '')
+        sizes.append(int(size) if size is not None else 0)
+        counts.append(int(count) if count is not None else 0)
+        types.append(type_ if type_ is not None else -1)
+        kinds.append(kind if kind is not None else -1)
+        flags.append(flag)
+
+    sections = {'sizes': sizes, 'counts': counts, 'types': types, 'kinds': kinds, 'flags': flags}
+    store.write_strings(sections, 'uris', uris)
+    store.write_strings(sections, 'labels', labels)
+    store.write_strings(sections, 'prototypes', prototypes)
+    store.write_strings(sections, 'names', names)
+    store.write_strings(sections, 'digests', digests)
+    store.write_strings(sections, 'categories', categories)
+    for name, rows in _list_orders(uris, data).items():
+        sections[name] = array('I', rows)
+    meta = {'version': version, 'count': len(uris), 'fingerprint': fingerprint,
+            'types': sorted(type_ids, key=type_ids.get), 'kinds': sorted(kind_ids, key=kind_ids.get),
+            'lists': bool(kind_ids)}
+    store.write(path, meta, sections)
+
+
+class SummaryStore:
+    """
+    Memory-mapped cluster summary: rows sorted by cluster uri, with interned
+    type strings, sizes/flags in typed arrays and pre-sorted cluster list orders.
+    """
+    def __init__(self, path):
+        self.__packed = packed = store.Packed(path)
+        if packed.meta.get('version') != version:
+            raise ValueError('Unsupported summary version in ' + path)
+        self.__uris = packed.strings('uris')
+        self.__labels = packed.strings('labels')
+        self.__sizes = packed.array('sizes')
+        self.__types = packed.array('types')
+        self.__flags = packed.array('flags')
+        self.__type_names = packed.meta['types']
+        self.__kind_names = packed.meta.get('kinds', [])
+        # summaries written by older versions lack the later columns
+        self.__prototypes = packed.strings('prototypes') if 'prototypes' in packed else None
+        self.__names = packed.strings('names') if 'names' in packed else None
+        self.__counts = packed.array('counts') if 'counts' in packed else None
+        self.__kinds = packed.array('kinds') if 'kinds' in packed else None
+        self.__digests = packed.strings('digests') if 'digests' in packed else None
+        self.__categories = packed.strings('categories') if 'categories' in packed else None
+
+    @property
+    def fingerprint(self):
+        return self.__packed.meta.get('fingerprint')
+
+    def __len__(self):
+        return len(self.__uris)
+
+    def __contains__(self, uri):
+        return self.row(uri) >= 0
+
+    def row(self, uri):
+        return self.__uris.find(str(uri))
+
+    def label(self, uri):
+        i = self.row(uri)
+        if i >= 0 and self.__flags[i] & HAS_LABEL:
+            return self.__labels[i]
+        return None
+
+    def type(self, uri):
+        i = self.row(uri)
+        if i >= 0 and self.__flags[i] & HAS_TYPE:
+            return self.__type_names[self.__types[i]]
+        return None
+
+    def size(self, uri):
+        i = self.row(uri)
+        if i >= 0 and self.__flags[i] & HAS_SIZE:
+            return self.__sizes[i]
+        return None
+
+    def count(self, uri):
+        i = self.row(uri)
+        if i >= 0 and self.__counts is not None and self.__flags[i] & HAS_COUNT:
+            return self.__counts[i]
+        return None
+
+    def kind(self, uri):
+        i = self.row(uri)
+        if i >= 0 and self.__kinds is not None and self.__kinds[i] >= 0:
+            return self.__kind_names[self.__kinds[i]]
+        return None
+
+    def digest(self, uri):
+        i = self.row(uri)
+        if i >= 0 and self.__digests is not None and self.__flags[i] & HAS_DIGEST:
+            return self.__digests[i]
+        return None
+
+    def prototype(self, uri):
+        i = self.row(uri)
+        if i >= 0 and self.__prototypes is not None and self.__flags[i] & HAS_PROTOTYPE:
+            return self.__prototypes[i]
+        return None
+
+    def order(self, kind, sortby='size'):
+        """
+        Rows of one cluster list in display order, or None if this summary has no such order.
+        """
+        name = order_section(str(kind), sortby)
+        if name in self.__packed:
+            return self.__packed.array(name)
+        if self.__packed.meta.get('lists') and sortby in sort_orders:
+            return self.__packed.array('flags')[:0]  # no cluster of this kind
+        return None
+
+    def seek(self, kind, count, uri):
+        """
+        Position in the size order of `kind` just after the (count, uri) key.
+        """
+        order = self.order(kind, 'size')
+        key = (-count, str(uri).encode('utf-8'))
+        lo, hi = 0, len(order)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            i = order[mid]
+            if (-self.__counts[i], self.__uris.raw(i)) <= key:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def list_row(self, i):
+        """
+        (uri, name, count) of a row, as shown in the cluster lists.
+        """
+        name = self.__names[i] if self.__flags[i] & HAS_NAME else None
+        return self.__uris[i], name, self.__counts[i]
+
+    def _record(self, i):
+        flag = self.__flags[i]
+        record = {}
+        if flag & HAS_SIZE:
+            record['size'] = self.__sizes[i]
+        if flag & HAS_LABEL:
+            record['label'] = self.__labels[i]
+        if flag & HAS_TYPE:
+            record['type'] = self.__type_names[self.__types[i]]
+        if self.__prototypes is not None and flag & HAS_PROTOTYPE:
+            record['prototype'] = self.__prototypes[i]
+        if self.__names is not None and flag & HAS_NAME:
+            record['name'] = self.__names[i]
+        if self.__counts is not None and flag & HAS_COUNT:
+            record['count'] = self.__counts[i]
+        if self.__kinds is not None and self.__kinds[i] >= 0:
+            record['kind'] = self.__kind_names[self.__kinds[i]]
+        if self.__digests is not None and flag & HAS_DIGEST:
+            record['digest'] = self.__digests[i]
+        if self.__categories is not None and flag & HAS_CATEGORY:
+            record['category'] = self.__categories[i]
+        return record
+
+    def __getitem__(self, uri):
+        i = self.row(uri)
+        if i < 0:
+            raise KeyError(uri)
+        return self._record(i)
+
+    def get(self, uri, default=None):
+        i = self.row(uri)
+        return self._record(i) if i >= 0 else default
+
+    def items(self):
+        for i in range(len(self)):
+            yield self.__uris[i], self._record(i)
+
+    def to_dict(self):
+        return dict(self.items())
+
+
+def load(path):
+    return SummaryStore(path)
+
+
+class SummaryRegistry:
+    """
+    Process-wide cache of loaded cluster summaries, one per (repo, graph).
+    A summary is reloaded only when its file's mtime or size changes.
+    """
+    def __init__(self):
+        self.__lock = threading.Lock()
+        self.__entries = {}  # (repo, graph) to (stamp, summary)
+        self.__key_locks = {}
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+
+    @staticmethod
+    def _stamp(path):
+        st = os.stat(path)
+        return st.st_mtime_ns, st.st_size
+
+    def __key_lock(self, key):
+        with self.__lock:
+            if key not in self.__key_locks:
+                self.__key_locks[key] = threading.Lock()
+            return self.__key_locks[key]
+
+    def get(self, repo, graph):
+        key = (repo, graph or None)
+        path = summary_path(repo, graph)
+        stamp = self._stamp(path)
+        entry = self.__entries.get(key)
+        if entry and entry[0] == stamp:
+            with self.__lock:
+                self.hits += 1
+            return entry[1]
+
+        # load under a per-key lock so concurrent first requests share one load
+        with self.__key_lock(key):
+            stamp = self._stamp(path)
+            entry = self.__entries.get(key)
+            if entry and entry[0] == stamp:
+                with self.__lock:
+                    self.hits += 1
+                return entry[1]
+            data = load(path)
+            with self.__lock:
+                self.misses += 1
+                if entry:
+                    self.reloads += 1
+                self.__entries[key] = (stamp, data)
+            return data
+
+    def discard(self, repo, graph):
+        with self.__lock:
+            self.__entries.pop((repo, graph or None), None)
+
+    def stats(self):
+        with self.__lock:
+            return {
+                'loaded': len(self.__entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'reloads': self.reloads,
+            }
+
+
+registry = SummaryRegistry()
@@ -1,50 +1,70 @@
-from rdflib import URIRef
-import pickle
+import batching
+import summary
 
+seedling = 'https://tac.nist.gov/tracks/SM-KBP/2019/ontologies/SeedlingOntology#'
+# types whose clusters fall back to the most frequent justification label, and the label prefix
+label_prefixes = {
+    'Person': '[P]',
+    'Time': '[T]',
+    'Facility': '[F]',
+    'Money': '[M]',
+    'Location': '[L]',
+    'Weapon': '[W]',
+    'Organization': '[O]',
+    'Vehicle': '[V]',
+}
 
-def run(sparql, graph, file_path, namespaces):
-    pickled = pickle.load(open(file_path, 'rb'))
 
+def enrich(sparql, graph, pickled, namespaces, clusters=None, progress=None):
+    """
+    Replace bare type labels with the most frequent justification label, in place.
+    Only clusters in `clusters` are considered when it is given.
+    """
     open_clause = close_clause = ''
     if graph:
         open_clause = 'GRAPH <%s> {' % graph
         close_clause = '}'
 
-
-    def query_justification_lbl(uri):
+    def query_justification_lbls(uris):
+        # label counts of every cluster in the batch; the most frequent one wins
         query = """
-        SELECT ?lbl 
+        SELECT ?cluster ?lbl (COUNT(?lbl) AS ?n)
         WHERE {
+            %s
             %s
             ?ms aida:cluster ?cluster ;
                 aida:clusterMember/aida:justifiedBy/skos:prefLabel ?lbl .
             %s
         }
-        GROUP BY ?lbl
-        ORDER BY DESC(COUNT(?lbl))
-        LIMIT 1
-        """ % (open_clause, close_clause)
-        for lbl, in sparql.query(query, namespaces, {'cluster': URIRef(uri)}):
-            return lbl
-
-
-    def query_justification_label_for_cluster_by_type(typ, prefix=''):
-        for uri, cluster in pickled.items():
-            if cluster['label'] == typ and cluster['type'] == 'https://tac.nist.gov/tracks/SM-KBP/2019/ontologies/SeedlingOntology#' + typ:
-                label = query_justification_lbl(uri)
-                if label:
-                    cluster['label'] = prefix + label
-
+        GROUP BY ?cluster ?lbl
+        """ % (batching.values('cluster', uris), open_clause, close_clause)
+        best = {}
+        for cluster, lbl, n in sparql.query(query, namespaces):
+            cluster, n = str(cluster), int(n)
+            if cluster not in best or n > best[cluster][1]:
+                best[cluster] = (lbl, n)
+        return {cluster: lbl for cluster, (lbl, _) in best.items()}
 
-    query_justification_label_for_cluster_by_type('Person', '[P]')
-    query_justification_label_for_cluster_by_type('Time', '[T]')
-    query_justification_label_for_cluster_by_type('Facility', '[F]')
-    query_justification_label_for_cluster_by_type('Money', '[M]')
-    query_justification_label_for_cluster_by_type('Location', '[L]')
-    query_justification_label_for_cluster_by_type('Weapon', '[W]')
-    query_justification_label_for_cluster_by_type('Organization', '[O]')
-    query_justification_label_for_cluster_by_type('Vehicle', '[V]')
+    # clusters that are still labelled with their bare type
+    candidates = {}
+    for uri in pickled if clusters is None else clusters:
+        cluster = pickled[uri]
+        typ = cluster.get('label')
+        if typ in label_prefixes and cluster.get('type') == seedling + typ:
+            candidates[uri] = label_prefixes[typ]
 
+    done = 0
+    for batch in batching.batches(candidates):
+        if progress:
+            progress('justification labels', done, len(candidates))
+        done += len(batch)
+        for uri, label in query_justification_lbls(batch).items():
+            if label:
+                pickled[uri]['label'] = candidates[uri] + label
 
-    pickle.dump(pickled, open(file_path, 'wb'))
 
+def run(sparql, graph, file_path, namespaces, progress=None):
+    current = summary.load(file_path)
+    pickled = current.to_dict()
+    enrich(sparql, graph, pickled, namespaces, progress=progress)
+    summary.write_summary(pickled, file_path, current.fingerprint)
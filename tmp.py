@@ -1,89 +1,181 @@
 from rdflib.namespace import split_uri
 from collections import defaultdict
-import pickle
+import batching
+import summary
 
 
-def run(sparql, graph, file_path, namespaces, AIDA):
+def _clauses(graph):
+    if graph:
+        return 'GRAPH <%s> {' % graph, '}'
+    return '', ''
 
-    data = defaultdict(dict)
 
-    open_clause = close_clause = ''
-    if graph:
-        open_clause = 'GRAPH <%s> {' % graph
-        close_clause = '}'
+def fingerprint(sparql, graph, namespaces):
+    """
+    Change detector for a graph: its membership and SameAsCluster counts, each
+    answered from a single predicate's statements rather than the whole graph.
+    A change that keeps both counts is only found by a forced refresh.
+    """
+    open_clause, close_clause = _clauses(graph)
+    counts = []
+    for query in ("SELECT (COUNT(?m) AS ?n) WHERE { %s ?m aida:cluster ?c %s }",
+                  "SELECT (COUNT(?c) AS ?n) WHERE { %s ?c a aida:SameAsCluster %s }"):
+        for n, in sparql.query(query % (open_clause, close_clause), namespaces):
+            counts.append(int(n))
+    return ':'.join(str(n) for n in counts)
 
+
+def _sizes(sparql, graph, namespaces, data):
+    open_clause, close_clause = _clauses(graph)
     query = """
-    SELECT ?cluster (COUNT(?member) AS ?size)
+    SELECT ?cluster (SAMPLE(?proto) AS ?prototype) (COUNT(?member) AS ?size)
+           (SUM(IF(BOUND(?proto) && ?member = ?proto, 1, 0)) AS ?protoN)
+           (MD5(GROUP_CONCAT(STR(?member); separator=" ")) AS ?digest)
     WHERE {
         %s
             ?membership aida:cluster ?cluster ;
                         aida:clusterMember ?member .
+            OPTIONAL { ?cluster aida:prototype ?proto }
         %s
     }
     GROUP BY ?cluster """ % (open_clause, close_clause)
 
-    for cluster, size in sparql.query(query, namespaces):
+    # the concatenation order is up to the endpoint: a different order only makes
+    # an unchanged cluster look changed, it never hides a changed one
+    for cluster, prototype, size, proto_n, digest in sparql.query(query, namespaces):
         cluster = str(cluster)
+        data[cluster]['digest'] = str(digest)
         data[cluster]['size'] = int(size)
+        # members without the prototype, as counted by the cluster lists
+        data[cluster]['count'] = int(size) - int(proto_n or 0)
+        if prototype:
+            data[cluster]['prototype'] = str(prototype)
 
-    # Entity
-    query = """
-    SELECT ?cluster ?label ?category
-    WHERE {
-        %s
-            ?cluster aida:prototype ?prototype .
-            ?prototype a aida:Entity .
-            OPTIONAL { ?prototype aida:hasName ?label }
-            OPTIONAL { ?statement rdf:subject ?prototype ;
-                                  rdf:predicate rdf:type ;
-                                  rdf:object ?category . }
-         %s
-    } """ % (open_clause, close_clause)
-
-    for cluster, label, type_ in sparql.query(query, namespaces):
-        if not label and type_:
+
+def _labels(sparql, graph, namespaces, AIDA, data, clusters=None, progress=None):
+    open_clause, close_clause = _clauses(graph)
+
+    # without clusters, every cluster of the graph is labelled in one pass
+    for batch in batching.batches(clusters) if clusters is not None else [None]:
+        values = batching.values('cluster', batch) if batch is not None else ''
+
+        if progress:
+            progress('entity clusters')
+
+        # Entity
+        query = """
+        SELECT ?cluster ?label ?category
+        WHERE {
+            %s
+            %s
+                ?cluster aida:prototype ?prototype .
+                ?prototype a aida:Entity .
+                OPTIONAL { ?prototype aida:hasName ?label }
+                OPTIONAL { ?statement rdf:subject ?prototype ;
+                                      rdf:predicate rdf:type ;
+                                      rdf:object ?category . }
+             %s
+        } """ % (values, open_clause, close_clause)
+
+        for cluster, label, type_ in sparql.query(query, namespaces):
+            name = label
+            if not label and type_:
+                _, label = split_uri(type_)
+            cluster = str(cluster)
+            data[cluster]['label'] = str(label) if label else cluster
+            data[cluster]['type'] = str(type_)
+            data[cluster]['category'] = str(type_) if type_ else ''
+            data[cluster]['kind'] = str(AIDA.Entity)
+            if name:
+                data[cluster]['name'] = str(name)
+
+        if progress:
+            progress('event clusters')
+
+        # Event
+        query = """
+        SELECT ?cluster ?category
+        WHERE {
+            %s
+            %s
+                ?cluster aida:prototype ?prototype .
+                ?prototype a aida:Event .
+                ?statement rdf:subject ?prototype ;
+                           rdf:predicate rdf:type ;
+                           rdf:object ?category .
+            %s
+        } """ % (values, open_clause, close_clause)
+
+        for cluster, type_ in sparql.query(query, namespaces):
             _, label = split_uri(type_)
-        cluster = str(cluster)
-        data[cluster]['label'] = str(label) if label else cluster
-        data[cluster]['type'] = str(type_)
+            cluster = str(cluster)
+            data[cluster]['label'] = str(label)
+            data[cluster]['type'] = str(type_)
+            data[cluster]['category'] = str(type_)
+            data[cluster]['kind'] = str(AIDA.Event)
+            data[cluster]['name'] = str(label)
 
-    # Event
-    query = """
-    SELECT ?cluster ?category
-    WHERE {
-        %s
-            ?cluster aida:prototype ?prototype .
-            ?prototype a aida:Event .
-            ?statement rdf:subject ?prototype ;
-                       rdf:predicate rdf:type ;
-                       rdf:object ?category .
-        %s
-    } """ % (open_clause, close_clause)
+        if progress:
+            progress('relation clusters')
 
-    for cluster, type_ in sparql.query(query, namespaces):
-        _, label = split_uri(type_)
-        cluster = str(cluster)
-        data[cluster]['label'] = str(label)
-        data[cluster]['type'] = str(type_)
+        # Relation
+        query = """
+        SELECT ?cluster ?type
+        WHERE {
+            %s
+            %s
+                ?cluster aida:prototype ?prototype .
+                ?prototype a aida:Relation .
+                ?statement rdf:subject ?prototype ;
+                           rdf:predicate rdf:type ;
+                           rdf:object ?type .
+            %s
+        } """ % (values, open_clause, close_clause)
 
-    # Relation
-    query = """
-    SELECT ?cluster ?type
-    WHERE {
-        %s
-            ?cluster aida:prototype ?prototype .
-            ?prototype a aida:Relation .
-            ?statement rdf:subject ?prototype ;
-                       rdf:predicate rdf:type ;
-                       rdf:object ?type .
-        %s
-    } """ % (open_clause, close_clause)
+        for cluster, type_ in sparql.query(query, namespaces):
+            _, label = split_uri(type_)
+            cluster = str(cluster)
+            data[cluster]['label'] = str(label)
+            data[cluster]['type'] = str(AIDA.Relation)
+            data[cluster]['category'] = str(type_)
+            data[cluster]['kind'] = str(AIDA.Relation)
+            data[cluster]['name'] = str(label)
 
-    for cluster, type_ in sparql.query(query, namespaces):
-        _, label = split_uri(type_)
-        cluster = str(cluster)
-        data[cluster]['label'] = str(label)
-        data[cluster]['type'] = str(AIDA.Relation)
 
-    pickle.dump(data, open(file_path, 'wb'))
+def collect(sparql, graph, namespaces, AIDA, progress=None):
+    data = defaultdict(dict)
+    if progress:
+        progress('cluster sizes')
+    _sizes(sparql, graph, namespaces, data)
+    _labels(sparql, graph, namespaces, AIDA, data, progress=progress)
+    return data
+
+
+def delta(sparql, graph, current, namespaces, AIDA, progress=None):
+    """
+    Recompute only clusters whose members (by digest), count or prototype differ
+    from the current summary, drop clusters that are gone, and keep everything else.
+    Returns the merged data and the list of recomputed clusters.
+    """
+    if progress:
+        progress('cluster sizes')
+    fresh = defaultdict(dict)
+    _sizes(sparql, graph, namespaces, fresh)
+
+    data = defaultdict(dict)
+    changed = []
+    for cluster, record in fresh.items():
+        if current.digest(cluster) == record['digest'] and current.count(cluster) == record['count'] \
+                and current.prototype(cluster) == record.get('prototype'):
+            data[cluster] = dict(current[cluster], size=record['size'])
+        else:
+            data[cluster] = record
+            changed.append(cluster)
+    print('Summary delta: %d of %d clusters changed (previously %d clusters)' % (len(changed), len(fresh), len(current)))
+
+    _labels(sparql, graph, namespaces, AIDA, data, changed, progress)
+    return data, changed
+
 
+def run(sparql, graph, file_path, namespaces, AIDA, progress=None):
+    summary.write_summary(collect(sparql, graph, namespaces, AIDA, progress), file_path)
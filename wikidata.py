@@ -0,0 +1,335 @@
+"""
+Wikidata lookups for GeoNames and Freebase ids: from a local crosswalk index
+when setting.wikidata_crosswalk points to one, otherwise from the live endpoint.
+
+The crosswalk is a packed file (see store.py) with rows sorted by key
+('geonames:<id>' or 'freebase:/m/...'), built from a Wikidata JSON dump with
+
+    python wikidata.py <dump.json[.gz|.bz2]> <crosswalk file>
+"""
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+import bz2
+import gzip
+import json
+import os
+import sys
+import threading
+import time
+import requests
+from rdflib import Literal
+from rdflib.namespace import Namespace, RDFS, SKOS
+import batching
+import cache
+import setting
+import store
+
+WD = 'http://www.wikidata.org/entity/'
+WDT = Namespace('http://www.wikidata.org/prop/direct/')
+namespaces = {
+    'wdt': WDT,
+    'rdfs': RDFS,
+    'skos': SKOS,
+}
+version = 1
+properties = {'P1566': 'geonames', 'P646': 'freebase'}
+_alias_separator = '\x1f'
+user_agent = 'gaia-cluster-viz'
+
+
+class Unavailable(Exception):
+    """
+    The live endpoint failed, timed out, or is skipped while the circuit breaker is open.
+    """
+
+
+class CircuitBreaker:
+    """
+    Opens after `threshold` consecutive failures; while open, calls are refused
+    until `reset_after` seconds have passed, then one trial call is let through.
+    """
+    def __init__(self, threshold=5, reset_after=60):
+        self.threshold = threshold
+        self.reset_after = reset_after
+        self.__lock = threading.Lock()
+        self.failures = 0
+        self.opened = None
+        self.trial = False
+        self.refused = 0
+
+    @property
+    def state(self):
+        if self.opened is None:
+            return 'closed'
+        return 'half-open' if time.time() - self.opened >= self.reset_after else 'open'
+
+    def allow(self):
+        with self.__lock:
+            state = self.state
+            if state == 'closed':
+                return True
+            if state == 'half-open' and not self.trial:
+                self.trial = True
+                return True
+            self.refused += 1
+            return False
+
+    def success(self):
+        with self.__lock:
+            self.failures = 0
+            self.opened = None
+            self.trial = False
+
+    def failure(self):
+        with self.__lock:
+            self.failures += 1
+            self.trial = False
+            if self.failures >= self.threshold or self.opened is not None:
+                self.opened = time.time()
+
+    def stats(self):
+        with self.__lock:
+            return {'state': self.state, 'failures': self.failures, 'refused': self.refused}
+
+
+pool = ThreadPoolExecutor(max_workers=setting.wikidata_workers, thread_name_prefix='wikidata')
+breaker = CircuitBreaker()
+# (kind, id[, aliases]) to resolved items, or False for ids known to have none
+memo = cache.LRUCache(setting.wikidata_memo_size)
+mid_prefixes = ('/m/', '/g/')
+counters = {'queries': 0, 'errors': 0, 'timeouts': 0}
+_counters_lock = threading.Lock()
+
+
+def _run(query):
+    # plain HTTP with a socket timeout: a hung endpoint ends the call instead of
+    # holding a pool thread after the caller stopped waiting for it
+    prefixes = ''.join('PREFIX %s: <%s>\n' % (prefix, ns) for prefix, ns in namespaces.items())
+    res = requests.get(setting.wikidata_endpoint, params={'query': prefixes + query},
+                       headers={'Accept': 'application/sparql-results+json', 'User-Agent': user_agent},
+                       timeout=setting.wikidata_timeout)
+    res.raise_for_status()
+    result = res.json()
+    names = result['head']['vars']
+    return [tuple(row[n]['value'] if n in row else None for n in names) for row in result['results']['bindings']]
+
+
+def _count(name):
+    with _counters_lock:
+        counters[name] += 1
+
+
+def _query(query):
+    """
+    Rows of a live query, run on the bounded pool with setting.wikidata_timeout.
+    Raises Unavailable instead of blocking on a slow or failing endpoint.
+    """
+    if not breaker.allow():
+        raise Unavailable('circuit open')
+    _count('queries')
+    future = pool.submit(_run, query)
+    try:
+        rows = future.result(timeout=setting.wikidata_timeout)
+    except TimeoutError:
+        _count('timeouts')
+        breaker.failure()
+        raise Unavailable('timed out')
+    except Exception as e:
+        _count('errors')
+        breaker.failure()
+        raise Unavailable(repr(e))
+    breaker.success()
+    return rows
+
+
+def stats():
+    return dict(counters, breaker=breaker.stats(), memo=memo.stats(), crosswalk=crosswalk() is not None)
+
+
+def freebase_mid(fbid):
+    """
+    Freebase mid as used by Wikidata (/m/0abc) of an id like 'LDC2015E42:m.0abc'.
+    """
+    return '/' + fbid[fbid.find(':')+1:].replace('.', '/')
+
+
+class Crosswalk:
+    def __init__(self, path):
+        self.__packed = packed = store.Packed(path)
+        if packed.meta.get('version') != version:
+            raise ValueError('Unsupported crosswalk version in ' + path)
+        self.__keys = packed.strings('keys')
+        self.__qids = packed.strings('qids')
+        self.__labels = packed.strings('labels')
+        self.__aliases = packed.strings('aliases')
+
+    def __len__(self):
+        return len(self.__keys)
+
+    def lookup(self, key):
+        """
+        (qid, label or None, aliases) of every item with the key, ordered by qid.
+        """
+        key = key.encode('utf-8')
+        i = self.__keys.bisect(key)
+        while i < len(self.__keys) and self.__keys.raw(i) == key:
+            aliases = self.__aliases[i]
+            yield self.__qids[i], self.__labels[i] or None, aliases.split(_alias_separator) if aliases else []
+            i += 1
+
+
+_crosswalk = None
+
+
+def crosswalk():
+    global _crosswalk
+    path = setting.wikidata_crosswalk
+    if _crosswalk is None and path and os.path.isfile(path):
+        _crosswalk = Crosswalk(path)
+    return _crosswalk
+
+
+def resolve(geonames_ids=(), mids=(), aliases=False):
+    """
+    Resolve GeoNames ids and Freebase mids together, with a few batched queries.
+    Returns ({geonames id: [{'qnode', 'url', 'label'}]}, {mid: {'qid', 'url', 'label', 'aliases'}}).
+    GeoNames labels fall back to the qnode; a mid resolves to its first item with
+    an English label. Aliases are only looked up when asked for.
+    Raises Unavailable if the live endpoint cannot be used.
+    """
+    geonames, freebase = {}, {}
+    index = crosswalk()
+    if index is not None:
+        for geonames_id in set(geonames_ids):
+            items = [{'qnode': qid, 'url': WD + qid, 'label': label or qid}
+                     for qid, label, _ in index.lookup('geonames:' + geonames_id)]
+            if items:
+                geonames[geonames_id] = items
+        for mid in set(mids):
+            for qid, label, item_aliases in index.lookup('freebase:' + mid):
+                if label:
+                    freebase[mid] = {'qid': qid, 'url': WD + qid, 'label': label,
+                                     'aliases': item_aliases if aliases else []}
+                    break
+        return geonames, freebase
+
+    # answers of the live endpoint are memoized, misses included; ids that cannot be
+    # Freebase mids (e.g. NIL variants) are never sent
+    geonames_ids = set(geonames_ids)
+    for geonames_id in list(geonames_ids):
+        items = memo.get(('geonames', geonames_id))
+        if items is not None:
+            geonames_ids.discard(geonames_id)
+            if items:
+                geonames[geonames_id] = items
+    mids = set(mids)
+    for mid in list(mids):
+        item = memo.get(('freebase', mid, aliases)) if mid.startswith(mid_prefixes) else False
+        if item is not None:
+            mids.discard(mid)
+            if item:
+                freebase[mid] = item
+
+    query = '''
+SELECT ?target ?qnode ?qnodeLabel
+WHERE
+{
+    %s
+    ?qnode wdt:P1566 ?target .
+    SERVICE wikibase:label { bd:serviceParam wikibase:language "[AUTO_LANGUAGE],en". }
+} '''
+    for batch in batching.batches(geonames_ids):
+        found = {}
+        for target, qnode, qnode_label in _query(query % batching.values('target', batch, Literal)):
+            url = str(qnode)
+            found.setdefault(str(target), []).append(
+                {'qnode': url[url.rfind('/')+1:], 'url': url, 'label': str(qnode_label)})
+        for geonames_id in batch:
+            _remember(('geonames', geonames_id), found.get(geonames_id))
+        geonames.update(found)
+
+    label_query = """
+        SELECT ?freebase ?qid ?label WHERE {
+          %s
+          ?qid wdt:P646 ?freebase .
+          ?qid rdfs:label ?label filter (lang(?label) = "en") .
+        }
+    """
+    alias_query = """
+        SELECT ?freebase ?qid ?alias WHERE {
+          %s
+          ?qid wdt:P646 ?freebase .
+          ?qid skos:altLabel ?alias filter (lang(?alias) = "en") .
+        }
+    """
+    for batch in batching.batches(mids):
+        found = {}
+        for mid, q_url, label in _query(label_query % batching.values('freebase', batch, Literal)):
+            if str(mid) not in found:
+                found[str(mid)] = {'qid': str(q_url).rsplit('/', 1)[1], 'url': str(q_url),
+                                   'label': str(label), 'aliases': []}
+        if aliases and found:
+            for mid, q_url, alias in _query(alias_query % batching.values('freebase', found, Literal)):
+                item = found[str(mid)]
+                if str(q_url) == item['url']:
+                    item['aliases'].append(str(alias))
+        for mid in batch:
+            _remember(('freebase', mid, aliases), found.get(mid))
+        freebase.update(found)
+    return geonames, freebase
+
+
+def _remember(key, value):
+    if value:
+        memo.put(key, value, setting.wikidata_memo_ttl)
+    else:
+        memo.put(key, False, setting.wikidata_memo_negative_ttl)
+
+
+def _open(path):
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rt', encoding='utf-8')
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rt', encoding='utf-8')
+    return open(path, encoding='utf-8')
+
+
+def _entities(path):
+    # the dump is a JSON array with one entity per line
+    with _open(path) as f:
+        for line in f:
+            line = line.strip().rstrip(',')
+            if line and line not in ('[', ']'):
+                yield json.loads(line)
+
+
+def build(dump_path, path):
+    rows = []
+    for entity in _entities(dump_path):
+        keys = []
+        for pid, prefix in properties.items():
+            for claim in entity.get('claims', {}).get(pid, []):
+                value = claim.get('mainsnak', {}).get('datavalue', {}).get('value')
+                if isinstance(value, str):
+                    keys.append(prefix + ':' + value)
+        if not keys:
+            continue
+        label = entity.get('labels', {}).get('en', {}).get('value', '')
+        aliases = _alias_separator.join(a['value'] for a in entity.get('aliases', {}).get('en', []))
+        for key in keys:
+            rows.append((key.encode('utf-8'), entity['id'], label, aliases))
+    rows.sort(key=lambda r: (r[0], len(r[1]), r[1]))
+
+    sections = {}
+    store.write_strings(sections, 'keys', [r[0] for r in rows])
+    store.write_strings(sections, 'qids', [r[1] for r in rows])
+    store.write_strings(sections, 'labels', [r[2] for r in rows])
+    store.write_strings(sections, 'aliases', [r[3] for r in rows])
+    store.write(path, {'version': version, 'count': len(rows), 'source': os.path.basename(dump_path)}, sections)
+    return len(rows)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        print('usage: python wikidata.py <wikidata dump> <crosswalk file>')
+        sys.exit(1)
+    print('Wrote %d crosswalk rows to %s' % (build(sys.argv[1], sys.argv[2]), sys.argv[2]))